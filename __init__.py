@@ -4,19 +4,19 @@ import step4_calibrate as calibrate
 import step5_diagnostic as diagnostic
 
 import utils.settings as settings
+import utils.utils as utils
 
 import pandas
 
 print("Inceput - Pas 1 - Preprocesare")
 
-preprocess.convert_sax_images(rescale=True, base_size=256, crop_size=256)
-preprocess.create_csv_data()
+preprocess.ingest_sax_files(rescale=True, base_size=256, crop_size=256)
 preprocess.enrich_dicom_csvdata()
 preprocess.enrich_traindata()
 
 print("Terminat - Pas 1 - Preprocesare")
 
-slice_data = pandas.read_csv(settings.RESULT_DIR + "dicom_data_enriched.csv", sep=";")
+slice_data = utils.load_metadata("dicom_data_enriched")
 predict.predict_patient(148, slice_data, '')
 
 print("Inceput - Pas 4 - Calibrare")
@@ -0,0 +1,129 @@
+import os
+import time
+import random
+
+import pandas
+
+import step1_preprocess as preprocess
+import utils.settings as settings
+
+
+def up_down(current_value, previous_value):
+    delta = current_value - previous_value
+    delta = delta.fillna(0)
+    updown = pandas.Series(delta.apply(lambda x: 0 if x == 0 else 1 if x > 0 else -1))
+
+    return updown
+
+
+def slice_delta(current_value, next_value):
+    delta = current_value - next_value
+    delta = delta.fillna(999)
+    return delta
+
+
+def count_small_deltas(current_value):
+    res = len(current_value[abs(current_value) < 2])
+    return res
+
+
+def enrich_dicom_frame_legacy(dicom_data):
+    """
+    Add the derived columns to the DICOM data with per group Python callbacks, the implementation replaced by
+    step1_preprocess.enrich_dicom_frame, kept as the reference of the benchmark.
+    :param dicom_data: data frame with the content of dicom_data.csv
+    :return: the enriched data frame
+    """
+
+    dicom_data["age_years"] = dicom_data["age"].apply(lambda x: preprocess.get_age_years(x))
+    dicom_data["patient_id_frame"] = dicom_data["patient_id"].map(str) + "_" + dicom_data["frame_no"].map(str)
+    dicom_data = dicom_data.sort_values(["patient_id", "frame_no", "slice_location", "file_name"],
+                                        ascending=[1, 1, 1, 1])
+
+    patient_grouped = dicom_data.groupby("patient_id_frame")
+    dicom_data['up_down'] = patient_grouped['time'].transform(lambda x: up_down(x, x.shift(1)))
+    dicom_data['up_down_agg'] = patient_grouped["up_down"].transform(lambda x: sum(x))
+    dicom_data['slice_location_sort'] = dicom_data['slice_location'] * dicom_data['up_down_agg']
+    dicom_data = dicom_data.sort_values(["patient_id", "frame_no", "slice_location_sort", "slice_location",
+                                         "file_name"])
+
+    patient_grouped = dicom_data.groupby("patient_id_frame")
+    dicom_data['slice_location_delta'] = patient_grouped['slice_location'].transform(
+        lambda x: slice_delta(x, x.shift(-1)))
+    dicom_data['small_slice_count'] = patient_grouped['slice_location_delta'].transform(lambda x: count_small_deltas(x))
+    dicom_data["slice_count"] = patient_grouped["up_down"].transform("count")
+    dicom_data["normal_slice_count"] = dicom_data["slice_count"] - dicom_data['small_slice_count']
+
+    dicom_data = dicom_data[dicom_data["slice_location_delta"] != 0].copy()
+
+    patient_grouped = dicom_data.groupby("patient_id_frame")
+    dicom_data['up_down'] = patient_grouped['time'].transform(lambda x: up_down(x, x.shift(1)))
+    dicom_data['up_down_agg'] = patient_grouped["up_down"].transform(lambda x: sum(x))
+
+    return dicom_data
+
+
+def create_dicom_data(patient_count=500, slice_count=12, frame_count=30, seed=1301):
+    """
+    Create a synthetic dicom_data.csv table
+    :param patient_count: number of patients
+    :param slice_count: slices per patient
+    :param frame_count: frames per slice
+    :param seed: random seed
+    :return: data frame with the dicom_data.csv columns used by the enrichment
+    """
+
+    rng = random.Random(seed)
+    rows = []
+
+    for patient_id in range(1, patient_count + 1):
+        age = rng.choice(["045Y", "061Y", "008M", "012W", "030Y"])
+        direction = rng.choice([1, -1])
+        duplicate_slice = rng.randint(0, slice_count - 1)
+
+        for slice_no in range(slice_count):
+            location = direction * slice_no * 10. + rng.random()
+            if slice_no == duplicate_slice:
+                location = direction * (slice_no - 1) * 10. + 1.
+
+            for frame_no in range(1, frame_count + 1):
+                rows.append([patient_id, slice_no + 1, frame_no, location, 100000. + slice_no * 10 + rng.random(),
+                             age, "IM-%04d-%04d" % (slice_no + 1, frame_no)])
+
+    return pandas.DataFrame(rows, columns=["patient_id", "slice_no", "frame_no", "slice_location", "time", "age",
+                                           "file_name"])
+
+
+def main():
+    """
+    Compare the vectorized enrich_dicom_frame with the per group implementation on dicom_data.csv or on a
+    synthetic table when the file does not exist
+    :return: nothing
+    """
+
+    csv_path = settings.BASE_DIR + settings.RESULT_DIR + "dicom_data.csv"
+
+    if os.path.exists(csv_path):
+        dicom_data = pandas.read_csv(csv_path, sep=";")
+    else:
+        dicom_data = create_dicom_data()
+
+    timings = {}
+    results = {}
+
+    for name, enrich in [("legacy", enrich_dicom_frame_legacy),
+                         ("vectorized", preprocess.enrich_dicom_frame)]:
+        start_time = time.time()
+        results[name] = enrich(dicom_data.copy())
+        timings[name] = time.time() - start_time
+
+    pandas.testing.assert_frame_equal(results["legacy"], results["vectorized"])
+
+    print("rows : " + str(len(dicom_data)))
+    for name in timings:
+        print(name.rjust(10) + " : " + str(round(timings[name], 3)) + " sec")
+    print("speedup : " + str(round(timings["legacy"] / max(timings["vectorized"], 1e-9), 1)) + "x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+from dicom.dataset import Dataset, FileDataset
+
+STAGES = ["convert_sax_images", "create_csv_data", "enrich_dicom_csvdata", "enrich_traindata", "ingest_sax_files"]
+
+
+def write_synthetic_dicom(path, patient_id, slice_no, frame_no, rows, columns, rng):
+    """
+    Write a synthetic SAX DICOM file with the tags read by DicomWrapper.
+    :param path: file path
+    :param patient_id: patient id
+    :param slice_no: slice number, used as series number
+    :param frame_no: frame number, used as instance number
+    :param rows: image rows
+    :param columns: image columns
+    :param rng: numpy random state
+    :return: nothing
+    """
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    file_meta.MediaStorageSOPInstanceUID = "1.2.3.%d.%d.%d" % (patient_id, slice_no, frame_no)
+    file_meta.TransferSyntaxUID = "1.2.840.10008.1.2.1"
+    file_meta.ImplementationClassUID = "1.2.3.4"
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    location = -50. + slice_no * 10.
+    ds.PatientID = str(patient_id)
+    ds.PatientAge = "0%02dY" % (20 + patient_id % 60)
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "M" if patient_id % 2 else "F"
+    ds.Manufacturer = "SIEMENS"
+    ds.ManufacturerModelName = "Avanto"
+    ds.SeriesNumber = slice_no
+    # no underscore, the description is a field of the '_' separated image names
+    ds.SeriesDescription = "sax%d" % slice_no
+    ds.SeriesTime = "101010.000000"
+    ds.SequenceName = "*tfi2d1_12"
+    ds.SequenceVariant = ["SK", "SS"]
+    ds.InstanceNumber = frame_no
+    ds.InstanceCreationTime = "%06d" % (101010 + slice_no * 10 + frame_no)
+    ds.SliceLocation = str(location)
+    ds.SliceThickness = "8"
+    ds.FlipAngle = "50"
+    ds.PixelSpacing = ["1.25", "1.25"]
+    ds.ImagePositionPatient = ["-150", "-120", str(location)]
+    ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+    ds.InPlanePhaseEncodingDirection = "ROW" if patient_id % 3 else "COL"
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = rng.randint(0, 4096, size=(rows, columns)).astype(numpy.uint16).tobytes()
+
+    ds.save_as(path)
+
+
+def generate_dataset(base_dir, patient_count, slice_count, frame_count, rows, columns):
+    """
+    Generate the data directory with synthetic SAX series and train_validate.csv.
+    :param base_dir: working directory
+    :param patient_count: number of patients
+    :param slice_count: slices per patient
+    :param frame_count: frames per slice
+    :param rows: image rows
+    :param columns: image columns
+    :return: number of files and total size in bytes
+    """
+
+    rng = numpy.random.RandomState(1301)
+    file_count = 0
+    total_bytes = 0
+
+    for patient_id in range(1, patient_count + 1):
+        for slice_no in range(1, slice_count + 1):
+            series_dir = os.path.join(base_dir, "data", "train", str(patient_id), "study", "sax_%d" % slice_no)
+            os.makedirs(series_dir)
+
+            for frame_no in range(1, frame_count + 1):
+                path = os.path.join(series_dir, "IM-%04d-%04d.dcm" % (slice_no, frame_no))
+                write_synthetic_dicom(path, patient_id, slice_no, frame_no, rows, columns, rng)
+                file_count += 1
+                total_bytes += os.path.getsize(path)
+
+    with open(os.path.join(base_dir, "data", "train_validate.csv"), "w") as f:
+        f.write("Id,Systole,Diastole\n")
+        for patient_id in range(1, patient_count + 1):
+            f.write("%d,%.1f,%.1f\n" % (patient_id, 60 + patient_id % 40, 150 + patient_id % 60))
+
+    os.makedirs(os.path.join(base_dir, "result"))
+
+    return file_count, total_bytes
+
+
+def run_stage(stage, workers, queue):
+    """
+    Run one step1 stage in a child process and report its wall time, the peak RSS of the stage process and the
+    largest peak RSS of its finished pool workers.
+    :param stage: stage name
+    :param workers: number of workers for ingest_sax_files
+    :param queue: queue for the result
+    :return: nothing
+    """
+
+    import step1_preprocess as preprocess
+
+    start_time = time.time()
+
+    if stage == "ingest_sax_files":
+        preprocess.ingest_sax_files(rescale=True, base_size=256, crop_size=256, workers=workers)
+    elif stage == "convert_sax_images":
+        preprocess.convert_sax_images(rescale=True, base_size=256, crop_size=256)
+    else:
+        getattr(preprocess, stage)()
+
+    elapsed = time.time() - start_time
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+
+def wait_stage(process, result_queue, timeout):
+    """
+    Wait for the result of a stage child process.
+    :param process: the child process
+    :param result_queue: queue with the result
+    :param timeout: maximum number of seconds for the stage
+    :return: wall time, peak RSS of the stage process and of its largest pool worker in KB, None if the child
+    failed or timed out
+    """
+
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                # the child may have put its result just before exiting
+                try:
+                    return result_queue.get(timeout=1)
+                except queue.Empty:
+                    return None
+
+    process.terminate()
+
+    return None
+
+
+def main():
+    """
+    Generate a synthetic dataset and time the step1 stages on it
+    :return: nothing
+    """
+
+    parser = argparse.ArgumentParser(description="step1 ingest throughput benchmark")
+    parser.add_argument("--patients", type=int, default=4)
+    parser.add_argument("--slices", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=208)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the generated working directory")
+    parser.add_argument("--timeout", type=float, default=3600, help="maximum number of seconds per stage")
+    args = parser.parse_args()
+
+    repo_dir = os.getcwd()
+    base_dir = tempfile.mkdtemp(prefix="bench_ingest_")
+    file_count, total_bytes = generate_dataset(base_dir, args.patients, args.slices, args.frames, args.rows,
+                                               args.columns)
+
+    results = {"patients": args.patients, "slices": args.slices, "frames": args.frames, "rows": args.rows,
+               "columns": args.columns, "workers": args.workers, "files": file_count, "bytes": total_bytes,
+               "stages": {}}
+
+    os.chdir(base_dir)
+    try:
+        for stage in STAGES:
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_stage, args=(stage, args.workers, result_queue))
+            process.start()
+            result = wait_stage(process, result_queue, args.timeout)
+            process.join()
+
+            if result is None:
+                results["stages"][stage] = {"failed": True, "exitcode": process.exitcode}
+                results["failed_stage"] = stage
+                break
+
+            elapsed, peak_rss_kb, peak_worker_rss_kb = result
+            results["stages"][stage] = {"seconds": round(elapsed, 4),
+                                        "files_per_sec": round(file_count / max(elapsed, 1e-9), 2),
+                                        "mb_per_sec": round(total_bytes / 1e6 / max(elapsed, 1e-9), 2),
+                                        "peak_rss_mb": round(max(peak_rss_kb, peak_worker_rss_kb) / 1024., 1),
+                                        "peak_rss_stage_mb": round(peak_rss_kb / 1024., 1),
+                                        "peak_rss_worker_mb": round(peak_worker_rss_kb / 1024., 1)}
+    finally:
+        os.chdir(repo_dir)
+
+        if not args.keep:
+            shutil.rmtree(base_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+    if "failed_stage" in results:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import time
+
+import numpy
+import tensorflow as tf
+
+import utils.settings as settings
+
+from step2_train_segmenter import LVSegmentation, FrozenLVSegmentation, get_checkpoint_dir
+
+
+def load_inputs(input_path, count):
+    """
+    Load the benchmark images, cached 224x224 images or synthetic normalized images.
+    :param input_path: optional .npy file with images of 224 x 224, e.g. prepared Sunnybrook images
+    :param count: number of images needed
+    :return: float32 array with the shape (count, 224, 224, 1)
+    """
+
+    if input_path:
+        images = numpy.load(input_path).astype(numpy.float32).reshape((-1, 224, 224, 1))
+        repeats = -(-count // len(images))
+
+        return numpy.concatenate([images] * repeats)[:count]
+
+    return numpy.random.RandomState(1301).randn(count, 224, 224, 1).astype(numpy.float32)
+
+
+def get_graph_path(architecture):
+    """
+    Get the frozen inference graph of an architecture, exported next to its checkpoint.
+    :param architecture: architecture name
+    :return: path of the graph file
+    """
+
+    return get_checkpoint_dir(architecture) + "inference_graph.pb"
+
+
+def create_segmenter(kind, architecture, session_config):
+    """
+    Build the segmenter and measure the cold start.
+    :param kind: 'checkpoint' or 'frozen'
+    :param architecture: architecture name
+    :param session_config: tf.ConfigProto
+    :return: segmenter, dictionary with the build and restore seconds and the weights origin
+    """
+
+    start_time = time.time()
+
+    if kind == 'frozen':
+        segmenter = FrozenLVSegmentation(get_graph_path(architecture), session_config=session_config)
+
+        return segmenter, {"build_seconds": round(time.time() - start_time, 4), "restore_seconds": 0.,
+                           "weights": "frozen"}
+
+    segmenter = LVSegmentation(architecture=architecture, session_config=session_config)
+    build_seconds = time.time() - start_time
+
+    weights = "random"
+    restore_seconds = 0.
+
+    if tf.train.get_checkpoint_state(segmenter.checkpoint_dir) is not None:
+        start_time = time.time()
+        segmenter.restore_session()
+        restore_seconds = time.time() - start_time
+        weights = "checkpoint"
+
+    return segmenter, {"build_seconds": round(build_seconds, 4), "restore_seconds": round(restore_seconds, 4),
+                       "weights": weights}
+
+
+def run_batches(segmenter, images, batch_size, iterations, with_uncertain=False):
+    """
+    Time the first batch and the steady state batches with the outputs fetched by step3.
+    :param segmenter: the segmenter
+    :param images: input images
+    :param batch_size: batch size
+    :param iterations: number of timed batches
+    :param with_uncertain: also fetch the uncertain pixel counts, as step3 with settings.COMPUTE_UNCERTAIN_PIXELS
+    :return: dictionary with the first batch time, images/sec and the latency percentiles
+    """
+
+    fetches = [segmenter.prediction]
+    if segmenter.pixel_counts is not None:
+        fetches.append(segmenter.pixel_counts)
+    if with_uncertain and segmenter.uncertain_counts is not None:
+        fetches.append(segmenter.uncertain_counts)
+
+    start_time = time.time()
+    segmenter.session.run(fetches, feed_dict={segmenter.x: images[:batch_size]})
+    first_batch = time.time() - start_time
+
+    latencies = []
+
+    for i in range(iterations):
+        offset = (i * batch_size) % (len(images) - batch_size + 1)
+        batch = images[offset:offset + batch_size]
+
+        start_time = time.time()
+        segmenter.session.run(fetches, feed_dict={segmenter.x: batch})
+        latencies.append(time.time() - start_time)
+
+    latencies = numpy.array(latencies) * 1000.
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+
+    return {"first_batch_seconds": round(first_batch, 4),
+            "images_per_sec": round(batch_size * iterations / (latencies.sum() / 1000.), 2),
+            "p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3), "p99_ms": round(float(p99), 3)}
+
+
+def main():
+    """
+    Run the segmenter over a grid of batch sizes and thread settings
+    :return: nothing
+    """
+
+    parser = argparse.ArgumentParser(description="segmentation inference benchmark")
+    parser.add_argument("--segmenter", choices=["checkpoint", "frozen"], default="checkpoint")
+    parser.add_argument("--architecture", default=settings.MODEL_NAME)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--intra-op-threads", type=int, nargs="+", default=[0],
+                        help="0 lets TensorFlow choose")
+    parser.add_argument("--inter-op-threads", type=int, nargs="+", default=[0],
+                        help="0 lets TensorFlow choose")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--with-uncertain", action="store_true", default=settings.COMPUTE_UNCERTAIN_PIXELS,
+                        help="also fetch the uncertain pixel counts")
+    parser.add_argument("--input", help=".npy file with cached 224x224 images instead of synthetic images")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    if args.segmenter == "frozen" and not os.path.exists(get_graph_path(args.architecture)):
+        parser.error(get_graph_path(args.architecture) + " does not exist, export the graph of " +
+                     args.architecture + " first")
+
+    images = load_inputs(args.input, max(args.batch_sizes) * 4)
+    results = {"segmenter": args.segmenter, "architecture": args.architecture,
+               "checkpoint_dir": get_checkpoint_dir(args.architecture), "iterations": args.iterations,
+               "with_uncertain": args.with_uncertain,
+               "runs": []}
+
+    for intra_op_threads in args.intra_op_threads:
+        for inter_op_threads in args.inter_op_threads:
+            session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                            inter_op_parallelism_threads=inter_op_threads)
+            segmenter, cold_start = create_segmenter(args.segmenter, args.architecture, session_config)
+
+            try:
+                for batch_size in args.batch_sizes:
+                    run = {"intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads,
+                           "batch_size": batch_size}
+                    run.update(cold_start)
+                    run.update(run_batches(segmenter, images, batch_size, args.iterations, args.with_uncertain))
+                    results["runs"].append(run)
+            finally:
+                segmenter.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
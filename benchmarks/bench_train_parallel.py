@@ -0,0 +1,80 @@
+import argparse
+import json
+import multiprocessing
+import shutil
+import tempfile
+
+import numpy
+
+import utils.settings as settings
+
+from step2_train_segmenter import get_architecture_parameters, train_data_parallel
+
+
+def write_synthetic_cache(cache_path, count, seed=1301):
+    """
+    Write a synthetic training set in the format of sunnybrook.cache_contours.
+    :param cache_path: path prefix of the .npy files
+    :param count: number of images
+    :param seed: seed of the random state
+    :return: nothing
+    """
+
+    rng = numpy.random.RandomState(seed)
+    numpy.save(cache_path + "_images.npy", rng.randint(0, 256, size=(count, 240, 240)).astype(numpy.uint8))
+    numpy.save(cache_path + "_labels.npy", rng.randint(0, 2, size=(count, 240, 240)).astype(numpy.uint8))
+
+
+def main():
+    """
+    Time the data-parallel training epochs on a synthetic training set for several worker counts
+    :return: nothing
+    """
+
+    parser = argparse.ArgumentParser(description="data-parallel segmenter training benchmark")
+    parser.add_argument("--architecture", default=settings.MODEL_NAME)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--images", type=int, default=64, help="number of synthetic training images")
+    parser.add_argument("--epochs", type=int, default=2, help="the first epoch is reported as warm-up")
+    parser.add_argument("--batch-size", type=int, default=2, help="batch size per worker")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix="bench_train_parallel_")
+    cache_path = base_dir + "/train"
+    write_synthetic_cache(cache_path, args.images)
+
+    results = {"architecture": args.architecture, "parameters": get_architecture_parameters(args.architecture),
+               "images": args.images, "epochs": args.epochs, "batch_size": args.batch_size,
+               "cpus": multiprocessing.cpu_count(), "runs": []}
+
+    try:
+        for workers in args.workers:
+            # random initial weights, the checkpoints go to the working directory
+            epoch_times = train_data_parallel(None, workers=workers, epochs=args.epochs, batch_size=args.batch_size,
+                                              architecture=args.architecture,
+                                              checkpoint_dir=base_dir + "/checkpoints_" + str(workers) + "/",
+                                              cache_path=cache_path)
+            steady_times = epoch_times[1:] or epoch_times
+            epoch_seconds = sum(steady_times) / len(steady_times)
+
+            results["runs"].append({"workers": workers,
+                                    "first_epoch_seconds": round(epoch_times[0], 4),
+                                    "epoch_seconds": round(epoch_seconds, 4),
+                                    "images_per_sec": round(args.images / max(epoch_seconds, 1e-9), 2)})
+    finally:
+        shutil.rmtree(base_dir)
+
+    for run in results["runs"]:
+        run["speedup"] = round(results["runs"][0]["epoch_seconds"] / max(run["epoch_seconds"], 1e-9), 3)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import step3_predict_volumes as predict_volumes
+import utils.settings as settings
+import utils.sunnybrook as sunnybrook
+import utils.utils as utils
+
+from step2_train_segmenter import FrozenLVSegmentation, count_graph_ops, load_graph_def, prepare_evaluation_images
+
+
+def dice_coefficient(predictions, labels):
+    """
+    Mean Dice coefficient of the predicted masks.
+    :param predictions: predicted masks
+    :param labels: ground truth masks
+    :return: mean Dice over the images
+    """
+
+    scores = []
+
+    for prediction, label in zip(predictions, labels):
+        prediction = prediction > 0
+        label = label > 0
+        total = prediction.sum() + label.sum()
+        scores.append(1. if total == 0 else 2. * numpy.logical_and(prediction, label).sum() / total)
+
+    return float(numpy.mean(scores))
+
+
+def timed_predict(segmenter, images, batch_size):
+    """
+    Segment the images in batches and measure the latency per image.
+    :param segmenter: FrozenLVSegmentation
+    :param images: prepared images
+    :param batch_size: batch size
+    :return: predictions and milliseconds per image
+    """
+
+    segmenter.predict(images[:1])
+
+    predictions = []
+    start_time = time.time()
+
+    for i in range(0, len(images), batch_size):
+        predictions.append(segmenter.predict(images[i:i + batch_size]))
+
+    elapsed = time.time() - start_time
+
+    return numpy.concatenate(predictions), 1000. * elapsed / max(len(images), 1)
+
+
+def compute_patient_volumes(patient_ids, segmenter, model_name):
+    """
+    Run the step3 segmentation and volume computation for some patients. The predictions are written to a
+    temporary directory so the step3 results in settings.PATIENT_PRED_DIR are left untouched.
+    :param patient_ids: patient ids
+    :param segmenter: the segmenter
+    :param model_name: name used for the areas files
+    :return: dictionary patient id -> (diastole volume, systole volume)
+    """
+
+    slice_data = utils.load_metadata("dicom_data_enriched")
+    patient_pred_dir = settings.PATIENT_PRED_DIR
+    settings.PATIENT_PRED_DIR = tempfile.mkdtemp(prefix="quantization_report_") + "/"
+    volumes = {}
+
+    try:
+        pixel_counts = predict_volumes.segment_patients(patient_ids, segmenter=segmenter)
+
+        for patient_id in patient_ids:
+            predict_volumes.count_pixels(patient_id, slice_data, model_name, pixel_counts=pixel_counts[patient_id])
+            res = predict_volumes.compute_volumes(patient_id, model_name)
+            volumes[patient_id] = (round(res[0], 2), round(res[1], 2))
+    finally:
+        shutil.rmtree(settings.PATIENT_PRED_DIR, ignore_errors=True)
+        settings.PATIENT_PRED_DIR = patient_pred_dir
+
+    return volumes
+
+
+def main():
+    """
+    Compare the int8 segmenter with the float32 segmenter on the Sunnybrook validation contours
+    and optionally on the step3 volumes of some patients. The int8 graph only quantizes the encoder convolutions, the
+    report lists the quantized and the remaining float ops
+    :return: nothing
+    """
+
+    parser = argparse.ArgumentParser(description="int8 vs float32 segmenter report")
+    parser.add_argument("--batch-size", type=int, default=settings.SEGMENT_BATCH_SIZE)
+    parser.add_argument("--patients", type=int, nargs="*", default=[], help="patient ids for the volume comparison")
+    parser.add_argument("--output", help="write the report as json to this file")
+    args = parser.parse_args()
+
+    _, val = sunnybrook.get_all_contours()
+    images, labels = sunnybrook.export_all_contours(val)
+    images = prepare_evaluation_images(images)
+    labels = labels[:, 8:8 + 224, 8:8 + 224]
+
+    float_segmenter = FrozenLVSegmentation(settings.SEGMENTER_GRAPH_PATH)
+    int8_segmenter = FrozenLVSegmentation(settings.SEGMENTER_QUANTIZED_GRAPH_PATH)
+
+    try:
+        float_predictions, float_latency = timed_predict(float_segmenter, images, args.batch_size)
+        int8_predictions, int8_latency = timed_predict(int8_segmenter, images, args.batch_size)
+
+        float_areas = numpy.array([prediction.sum() for prediction in float_predictions], dtype=numpy.float64)
+        int8_areas = numpy.array([prediction.sum() for prediction in int8_predictions], dtype=numpy.float64)
+
+        report = {"images": len(images),
+                  "int8_ops": count_graph_ops(load_graph_def(settings.SEGMENTER_QUANTIZED_GRAPH_PATH)),
+                  "note": "only the encoder convolutions are quantized, conv2d_transpose, max_pool_with_argmax "
+                          "and scatter_nd run in float32",
+                  "float32": {"dice": round(dice_coefficient(float_predictions, labels), 4),
+                              "ms_per_image": round(float_latency, 3)},
+                  "int8": {"dice": round(dice_coefficient(int8_predictions, labels), 4),
+                           "ms_per_image": round(int8_latency, 3)},
+                  "mask_agreement": round(float(numpy.mean(float_predictions == int8_predictions)), 5),
+                  "mean_relative_area_diff": round(float(numpy.mean(
+                      numpy.abs(int8_areas - float_areas) / numpy.maximum(float_areas, 1))), 5)}
+
+        if len(args.patients) > 0:
+            float_volumes = compute_patient_volumes(args.patients, float_segmenter, "float32_report")
+            int8_volumes = compute_patient_volumes(args.patients, int8_segmenter, "int8_report")
+
+            report["volumes"] = {str(patient_id): {"float32": float_volumes[patient_id],
+                                                   "int8": int8_volumes[patient_id]}
+                                 for patient_id in args.patients}
+    finally:
+        float_segmenter.close()
+        int8_segmenter.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
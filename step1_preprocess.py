@@ -1,13 +1,59 @@
 import csv
 import pandas
-import scipy
-import scipy.misc
 import cv2
 import numpy as np
 import os
+import sys
+import time
+import multiprocessing
 import utils.sunnybrook as sunnybrook
 import utils.utils as utils
+import utils.image_store as image_store
 import utils.settings as settings
+from utils.utils_dicom import DicomWrapper
+from utils.dicom_index import DicomIndex
+
+
+CSV_COLUMNS = ["patient_id", "slice_no", "frame_no", "rows", "columns", "spacing", "slice_thickness", "slice_location",
+               "slice_location2", "plane", "image_position", "sv", "time", "manufact", "modelname", "age", "birth",
+               "sex", "file_name", "angle", "o1", "o2", "o3", "o4", "o5", "o6"]
+
+
+def get_csv_row(dicom_data):
+    """
+    Extract the CSV fields of a DICOM file
+    :param dicom_data: the DICOM file
+    :return: list with the values of CSV_COLUMNS
+    """
+
+    return [
+        str(dicom_data.patient_id),
+        str(dicom_data.series_number),
+        str(dicom_data.instance_number),
+        str(dicom_data.rows),
+        str(dicom_data.columns),
+        str(dicom_data.spacing[0]),
+        str(dicom_data.slice_thickness),
+        str(dicom_data.slice_location),
+        str(dicom_data.get_location()),
+        dicom_data.in_plane_encoding_direction,
+        str(dicom_data.image_position),
+        str(dicom_data.get_value("SequenceVariant")),
+        str(dicom_data.get_value("InstanceCreationTime")),
+        str(dicom_data.get_value("Manufacturer")),
+        str(dicom_data.get_value("ManufacturerModelName")),
+        str(dicom_data.get_value("PatientAge")),
+        str(dicom_data.get_value("PatientBirthDate")),
+        str(dicom_data.get_value("PatientSex")),
+        dicom_data.file_name.replace(".dcm", ""),
+        str(dicom_data.get_value("FlipAngle")),
+        str(round(dicom_data.image_orientation_patient[0], 2)),
+        str(round(dicom_data.image_orientation_patient[1], 2)),
+        str(round(dicom_data.image_orientation_patient[2], 2)),
+        str(round(dicom_data.image_orientation_patient[3], 2)),
+        str(round(dicom_data.image_orientation_patient[4], 2)),
+        str(round(dicom_data.image_orientation_patient[5], 2))
+    ]
 
 
 def create_csv_data():
@@ -18,65 +64,7 @@ def create_csv_data():
 
     print("   > Salvarea datelor DICOM intr-un fisier CSV")
 
-    row_no = 0
-
-    with open(settings.BASE_DIR + settings.RESULT_DIR + "dicom_data.csv", "w") as csv_file:
-        csv_writer = csv.writer(csv_file, delimiter=";", quoting=csv.QUOTE_MINIMAL)
-        csv_writer.writerow(
-            ["patient_id", "slice_no", "frame_no", "rows", "columns", "spacing", "slice_thickness", "slice_location",
-             "slice_location2", "plane", "image_position", "sv", "time", "manufact", "modelname", "age", "birth", "sex",
-             "file_name", "angle", "o1", "o2", "o3", "o4", "o5", "o6"])
-
-        for dicom_data in utils.enumerate_sax_files():
-            row_no += 1
-
-            csv_writer.writerow([
-                str(dicom_data.patient_id),
-                str(dicom_data.series_number),
-                str(dicom_data.instance_number),
-                str(dicom_data.rows),
-                str(dicom_data.columns),
-                str(dicom_data.spacing[0]),
-                str(dicom_data.slice_thickness),
-                str(dicom_data.slice_location),
-                str(dicom_data.get_location()),
-                dicom_data.in_plane_encoding_direction,
-                str(dicom_data.image_position),
-                str(dicom_data.get_value("SequenceVariant")),
-                str(dicom_data.get_value("InstanceCreationTime")),
-                str(dicom_data.get_value("Manufacturer")),
-                str(dicom_data.get_value("ManufacturerModelName")),
-                str(dicom_data.get_value("PatientAge")),
-                str(dicom_data.get_value("PatientBirthDate")),
-                str(dicom_data.get_value("PatientSex")),
-                dicom_data.file_name.replace(".dcm", ""),
-                str(dicom_data.get_value("FlipAngle")),
-                str(round(dicom_data.image_orientation_patient[0], 2)),
-                str(round(dicom_data.image_orientation_patient[1], 2)),
-                str(round(dicom_data.image_orientation_patient[2], 2)),
-                str(round(dicom_data.image_orientation_patient[3], 2)),
-                str(round(dicom_data.image_orientation_patient[4], 2)),
-                str(round(dicom_data.image_orientation_patient[5], 2))
-            ])
-
-
-def up_down(current_value, previous_value):
-    delta = current_value - previous_value
-    delta = delta.fillna(0)
-    updown = pandas.Series(delta.apply(lambda x: 0 if x == 0 else 1 if x > 0 else -1))
-
-    return updown
-
-
-def slice_delta(current_value, next_value):
-    delta = current_value - next_value
-    delta = delta.fillna(999)
-    return delta
-
-
-def count_small_deltas(current_value):
-    res = len(current_value[abs(current_value) < 2])
-    return res
+    write_dicom_data([get_csv_row(dicom_data) for dicom_data in utils.enumerate_sax_files(metadata_only=True)])
 
 
 def get_age_years(age_string):
@@ -101,41 +89,120 @@ def get_age_years(age_string):
     return res
 
 
-def enrich_dicom_csvdata():
+def get_frame_groups(dicom_data):
     """
-    Write in csv file
-    :return: nothing
+    Find the patient_id_frame groups of a data frame sorted by patient_id and frame_no.
+    :param dicom_data: the sorted data frame
+    :return: group number of every row, the first row of every group and the last row of every group
     """
 
-    print("   > Adaugarea de noi coloane la fisierul CSV")
+    patient_ids = dicom_data["patient_id"].values
+    frame_nos = dicom_data["frame_no"].values
 
-    dicom_data = pandas.read_csv(settings.BASE_DIR + settings.RESULT_DIR + "dicom_data.csv", sep=";")
-    dicom_data["age_years"] = dicom_data["age"].apply(lambda x: get_age_years(x))
+    starts = np.ones(len(dicom_data), dtype=bool)
+    starts[1:] = (patient_ids[1:] != patient_ids[:-1]) | (frame_nos[1:] != frame_nos[:-1])
+    ends = np.ones(len(dicom_data), dtype=bool)
+    ends[:-1] = starts[1:]
+
+    return np.cumsum(starts) - 1, starts, ends
+
+
+def get_group_sums(group_ids, values):
+    """
+    Sum the values of every group and broadcast the sum back to the rows.
+    :param group_ids: group number of every row
+    :param values: the values
+    :return: the sum of the group of every row
+    """
+
+    return np.bincount(group_ids, weights=values)[group_ids]
+
+
+def get_up_down(dicom_data, group_ids, starts):
+    """
+    Vectorized up_down: the sign of the time delta to the previous slice of the same group.
+    :param dicom_data: the sorted data frame
+    :param group_ids: group number of every row
+    :param starts: the first row of every group
+    :return: up_down and up_down_agg values
+    """
+
+    times = dicom_data["time"].values.astype(np.float64)
+    delta = np.zeros(len(times))
+    delta[1:] = times[1:] - times[:-1]
+    delta[starts] = 0
+    delta[np.isnan(delta)] = 0
+
+    res = np.sign(delta).astype(np.int64)
+
+    return res, get_group_sums(group_ids, res).astype(np.int64)
+
+
+def enrich_dicom_frame(dicom_data):
+    """
+    Add the derived columns to the DICOM data. The per group values are computed with shifted differences and
+    group sums on the sorted frame.
+    :param dicom_data: data frame with the content of dicom_data.csv
+    :return: the enriched data frame
+    """
+
+    ages = dicom_data["age"].unique()
+    dicom_data["age_years"] = dicom_data["age"].map(dict(zip(ages, [get_age_years(age) for age in ages])))
     dicom_data["patient_id_frame"] = dicom_data["patient_id"].map(str) + "_" + dicom_data["frame_no"].map(str)
-    dicom_data = dicom_data.sort(["patient_id", "frame_no", "slice_location", "file_name"], ascending=[1, 1, 1, 1])
+    dicom_data = dicom_data.sort_values(["patient_id", "frame_no", "slice_location", "file_name"],
+                                        ascending=[1, 1, 1, 1])
 
-    patient_grouped = dicom_data.groupby("patient_id_frame")
-    dicom_data['up_down'] = patient_grouped['time'].apply(lambda x: up_down(x, x.shift(1)))
-    dicom_data['up_down_agg'] = patient_grouped["up_down"].transform(lambda x: sum(x))
+    group_ids, starts, ends = get_frame_groups(dicom_data)
+    dicom_data['up_down'], dicom_data['up_down_agg'] = get_up_down(dicom_data, group_ids, starts)
     dicom_data['slice_location_sort'] = dicom_data['slice_location'] * dicom_data['up_down_agg']
-    dicom_data = dicom_data.sort(["patient_id", "frame_no", "slice_location_sort", "slice_location", "file_name"])
-
-    patient_grouped = dicom_data.groupby("patient_id_frame")
-    dicom_data['slice_location_delta'] = patient_grouped['slice_location'].apply(lambda x: slice_delta(x, x.shift(-1)))
-    dicom_data['small_slice_count'] = patient_grouped['slice_location_delta'].transform(lambda x: count_small_deltas(x))
-    dicom_data["slice_count"] = patient_grouped["up_down"].transform("count")
+    dicom_data = dicom_data.sort_values(["patient_id", "frame_no", "slice_location_sort", "slice_location",
+                                         "file_name"])
+
+    group_ids, starts, ends = get_frame_groups(dicom_data)
+    locations = dicom_data['slice_location'].values.astype(np.float64)
+    delta = np.zeros(len(locations))
+    delta[:-1] = locations[:-1] - locations[1:]
+    delta[ends] = np.nan
+    delta[np.isnan(delta)] = 999
+    dicom_data['slice_location_delta'] = delta
+    dicom_data['small_slice_count'] = get_group_sums(group_ids, np.abs(delta) < 2).astype(np.int64)
+    dicom_data["slice_count"] = np.bincount(group_ids)[group_ids].astype(np.int64)
     dicom_data["normal_slice_count"] = dicom_data["slice_count"] - dicom_data['small_slice_count']
 
-    dicom_data = dicom_data[dicom_data["slice_location_delta"] != 0]
+    dicom_data = dicom_data[dicom_data["slice_location_delta"] != 0].copy()
+
+    group_ids, starts, ends = get_frame_groups(dicom_data)
+    dicom_data['up_down'], dicom_data['up_down_agg'] = get_up_down(dicom_data, group_ids, starts)
+
+    return dicom_data
 
-    patient_grouped = dicom_data.groupby("patient_id_frame")
-    dicom_data['up_down'] = patient_grouped['time'].apply(lambda x: up_down(x, x.shift(1)))
-    dicom_data['up_down_agg'] = patient_grouped["up_down"].transform(lambda x: sum(x))
 
-    dicom_data.to_csv(settings.BASE_DIR + settings.RESULT_DIR + "dicom_data_enriched.csv", sep=";")
+def enrich_dicom_csvdata(patient_ids=None):
+    """
+    Write in csv file
+    :param patient_ids: recompute only these patients and keep the others from the previous
+    dicom_data_enriched.csv, e.g. DicomIndex().get_changed_patients()
+    :return: nothing
+    """
+
+    print("   > Adaugarea de noi coloane la fisierul CSV")
+
+    dicom_data = utils.load_metadata("dicom_data")
+
+    if patient_ids is not None and os.path.exists(utils.get_metadata_path("dicom_data_enriched")):
+        previous_data = utils.load_metadata("dicom_data_enriched", index_col=0)
+        previous_data = previous_data[~previous_data["patient_id"].isin(patient_ids)]
+        dicom_data = enrich_dicom_frame(dicom_data[dicom_data["patient_id"].isin(patient_ids)].copy())
+        dicom_data = pandas.concat([previous_data, dicom_data])
+        dicom_data = dicom_data.sort_values(
+            ["patient_id", "frame_no", "slice_location_sort", "slice_location", "file_name"], kind="mergesort")
+    else:
+        dicom_data = enrich_dicom_frame(dicom_data)
+
+    utils.save_metadata(dicom_data, "dicom_data_enriched")
 
     dicom_data = dicom_data[dicom_data["frame_no"] == 1]
-    dicom_data.to_csv(settings.BASE_DIR + settings.RESULT_DIR + "dicom_data_enriched_frame1.csv", sep=";")
+    utils.save_metadata(dicom_data, "dicom_data_enriched_frame1")
 
 
 def enrich_traindata():
@@ -147,7 +214,7 @@ def enrich_traindata():
     print("   > Adaugarea de noi coloane la datele de antrenare")
 
     train_data = pandas.read_csv(settings.BASE_DIR + settings.DATA_DIR + "train_validate.csv", sep=",")
-    dicom_data = pandas.read_csv(settings.BASE_DIR + settings.RESULT_DIR + "dicom_data_enriched_frame1.csv", sep=";")
+    dicom_data = utils.load_metadata("dicom_data_enriched_frame1")
     patient_grouped = dicom_data.groupby("patient_id")
 
     enriched_traindata = patient_grouped.first().reset_index()
@@ -225,62 +292,297 @@ def get_square_crop(img, base_size=256, crop_size=256):
     return res
 
 
-def convert_sax_images(rescale=True, base_size=256, crop_size=256):
+def prepare_target_dir():
+    """
+    Create the directory for the preprocessed images and delete the old images.
+    :return: the directory path
+    """
+
+    target_dir = settings.BASE_PREPROCESSEDIMAGES_DIR
+
+    utils.delete_files(target_dir, "*.png")
+
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    return target_dir
+
+
+def convert_sax_image(dicom_data, target_dir, rescale=True, base_size=256, crop_size=256, sink=None):
+    """
+    Convert one DICOM file in a png image and write it in target_dir. The image is prepared in memory and
+    encoded only once.
+    :param dicom_data: the DICOM file
+    :param target_dir: the directory for the image
+    :param rescale: boolean value for rescaling image.
+    :param base_size: base size
+    :param crop_size: crop size
+    :param sink: optional function called with the image path and the uint8 image instead of writing the png
+    :return: the image path
+    """
+
+    if dicom_data.in_plane_encoding_direction not in ["ROW", "COL"]:
+        raise Exception("ROW,COL")
+
+    if dicom_data.spacing[0] != dicom_data.spacing[1]:
+        raise Exception("Data spacings not equal")
+
+    location_id = int(dicom_data.slice_location) + 10000
+    location_id_str = str(location_id).rjust(5, '0')
+
+    img_path = target_dir + str(dicom_data.patient_id).rjust(4, '0') + "_" + dicom_data.series_description.rjust(8,
+                                                                                                                 '0') + "_" + str(
+        dicom_data.instance_number).rjust(2, '0') + "_" + location_id_str + "_" + dicom_data.file_name.replace(
+        ".dcm", ".png")
+
+    img = dicom_data.pixel_array_uint8
+    if dicom_data.in_plane_encoding_direction == "COL":
+        img = cv2.transpose(img)
+        img = cv2.flip(img, 0)
+
+    if rescale:
+        scale = dicom_data.spacing[0]
+        img = cv2.resize(img, (0, 0), fx=scale, fy=scale)
+
+    sq_img = get_square_crop(img, base_size=base_size, crop_size=crop_size)
+    clahe = cv2.createCLAHE(tileGridSize=(1, 1))
+    cl_img = clahe.apply(sq_img)
+
+    if sink is None:
+        cv2.imwrite(img_path, cl_img)
+    else:
+        sink(img_path, cl_img)
+
+    return img_path
+
+
+def convert_sax_images(rescale=True, base_size=256, crop_size=256, patient_ids=None):
     """
     Convert dicom format in png images and write them in a specific folder.
     :param rescale: boolean value for rescaling image.
     :param base_size: base size
     :param crop_size: crop size
+    :param patient_ids: convert only these patients, e.g. DicomIndex().get_changed_patients()
+    :return: nothing
+    """
+
+    if patient_ids is None:
+        target_dir = prepare_target_dir()
+    else:
+        target_dir = settings.BASE_PREPROCESSEDIMAGES_DIR
+        utils.create_dir_if_not_exists(target_dir)
+
+        for patient_id in patient_ids:
+            utils.delete_files(target_dir, str(patient_id).rjust(4, '0') + "_*.png")
+
+    print('   > Convertirea fisierelor DICOM in fisiere PNG')
+
+    for dicom_data in utils.enumerate_sax_files(patient_ids=patient_ids):
+        convert_sax_image(dicom_data, target_dir, rescale=rescale, base_size=base_size, crop_size=crop_size)
+
+
+def ingest_patient(task):
+    """
+    Ingest DICOM files of a patient, used as work unit for the process pool.
+    :param task: tuple with the patient directory, the DICOM paths, target directory, rescale, base size and crop size
+    :return: worker process id, list with (DICOM path, image path, CSV row) and the time spent
+    """
+
+    patient_dir, file_paths, target_dir, rescale, base_size, crop_size = task
+    start_time = time.time()
+    records = []
+    patient_images = {}
+
+    for file_path in file_paths:
+        file_dir, file_name = os.path.split(file_path)
+        dicom_data = DicomWrapper(file_dir + "/", file_name)
+        sink = None
+
+        if settings.USE_IMAGE_STORE:
+            sink = lambda img_path, img: patient_images.setdefault(dicom_data.patient_id, []).append(
+                (img_path, img, dicom_data.instance_number, dicom_data.series_description, dicom_data.slice_location))
+
+        img_path = convert_sax_image(dicom_data, target_dir, rescale=rescale, base_size=base_size,
+                                     crop_size=crop_size, sink=sink)
+        records.append((file_path, img_path, get_csv_row(dicom_data)))
+
+    for patient_id, images in patient_images.items():
+        image_store.write_patient_images(patient_id, images)
+
+    return os.getpid(), records, time.time() - start_time
+
+
+INT_COLUMNS = ["patient_id", "slice_no", "frame_no", "rows", "columns"]
+FLOAT_COLUMNS = ["spacing", "slice_thickness", "slice_location", "time", "angle", "o1", "o2", "o3", "o4", "o5", "o6"]
+
+
+def split_vector_column(values, prefix):
+    """
+    Split a column with 3-vectors written as text, e.g. "[x y z]", in three float columns.
+    :param values: the text column
+    :param prefix: prefix of the new columns
+    :return: data frame with the columns prefix_x, prefix_y and prefix_z
+    """
+
+    res = values.str.replace(r"[\[\]',]", " ", regex=True).str.split(expand=True).astype(np.float64)
+    res.columns = [prefix + "_x", prefix + "_y", prefix + "_z"]
+
+    return res
+
+
+def get_typed_dicom_data(rows):
+    """
+    Convert the CSV rows in a typed table: integer ids, float measurements and the location and position vectors
+    as numeric columns instead of text.
+    :param rows: the CSV rows
+    :return: data frame
+    """
+
+    dicom_data = pandas.DataFrame(rows, columns=CSV_COLUMNS)
+
+    for column in INT_COLUMNS:
+        dicom_data[column] = pandas.to_numeric(dicom_data[column]).astype(np.int32)
+
+    for column in FLOAT_COLUMNS:
+        dicom_data[column] = pandas.to_numeric(dicom_data[column]).astype(np.float64)
+
+    locations = split_vector_column(dicom_data["slice_location2"], "location")
+    positions = split_vector_column(dicom_data["image_position"], "image_position")
+    dicom_data = dicom_data.drop(["slice_location2", "image_position"], axis=1)
+
+    return pandas.concat([dicom_data, locations, positions], axis=1)
+
+
+def write_dicom_data(rows):
+    """
+    Write dicom_data.csv, or the typed dicom_data.npy when settings.METADATA_FORMAT is "npy"
+    :param rows: the CSV rows
     :return: nothing
     """
 
+    if settings.METADATA_FORMAT == "npy":
+        utils.save_metadata(get_typed_dicom_data(rows), "dicom_data")
+        return
+
+    with open(settings.BASE_DIR + settings.RESULT_DIR + "dicom_data.csv", "w") as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(CSV_COLUMNS)
+        csv_writer.writerows(rows)
+
+
+def ingest_sax_files(rescale=True, base_size=256, crop_size=256, workers=None, incremental=False):
+    """
+    Walk the data directory once and, for every DICOM file, write the preprocessed png image and the
+    dicom_data.csv row from the same parsed file. The work is split by patient directory, with more than one
+    worker the patients are processed in a process pool. The rows are kept in the DICOM index, with incremental
+    only the new or changed files are parsed and the deleted files are dropped.
+    :param rescale: boolean value for rescaling image.
+    :param base_size: base size
+    :param crop_size: crop size
+    :param workers: number of worker processes, by default settings.PREPROCESS_WORKERS
+    :param incremental: reuse the DICOM index of the previous run
+    :return: the ids of the changed patients
+    """
+
+    if workers is None:
+        workers = settings.PREPROCESS_WORKERS
+
     target_dir = settings.BASE_PREPROCESSEDIMAGES_DIR
+    utils.create_dir_if_not_exists(target_dir)
 
-    utils.delete_files(target_dir, "*.png")
+    print('   > Convertirea fisierelor DICOM in fisiere PNG si salvarea datelor DICOM intr-un fisier CSV')
 
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
+    index = DicomIndex()
 
-    print('   > Convertirea fisierelor DICOM in fisiere PNG')
+    if not incremental:
+        utils.delete_files(target_dir, "*.png")
+        utils.delete_files(settings.IMAGE_STORE_DIR, "*.npy")
+        utils.delete_files(settings.IMAGE_STORE_DIR, "*.json")
+        index.clear()
 
-    file_count = 0
-    for dicom_data in utils.enumerate_sax_files():
-        file_count += 1
+    file_stats = {}
+    patient_dirs = {}
 
-        if dicom_data.in_plane_encoding_direction not in ["ROW", "COL"]:
-            raise Exception("ROW,COL")
+    for file_dir, file_name in utils.enumerate_sax_paths():
+        file_path = file_dir + file_name
+        file_stat = os.stat(file_path)
+        file_stats[file_path] = (file_stat.st_size, file_stat.st_mtime_ns)
+        patient_dirs[file_path] = "/".join(file_dir.split('/')[:-3])
 
-        if dicom_data.spacing[0] != dicom_data.spacing[1]:
-            raise Exception("Data spacings not equal")
+    changed, deleted = index.get_changes(file_stats)
+    changed_patients = set()
+    changed_dirs = set(patient_dirs[file_path] for file_path in changed)
 
-        location_id = int(dicom_data.slice_location) + 10000
-        location_id_str = str(location_id).rjust(5, '0')
+    for file_path in changed + deleted:
+        indexed = index.get_file(file_path)
 
-        img_path = target_dir + str(dicom_data.patient_id).rjust(4, '0') + "_" + dicom_data.series_description.rjust(8,
-                                                                                                                     '0') + "_" + str(
-            dicom_data.instance_number).rjust(2, '0') + "_" + location_id_str + "_" + dicom_data.file_name.replace(
-            ".dcm", ".png")
-        scipy.misc.imsave(img_path, dicom_data.pixel_array)
+        if indexed is not None:
+            changed_patients.add(indexed[0])
+            changed_dirs.add(indexed[2])
 
-        img = cv2.imread(img_path, 0)
-        if dicom_data.in_plane_encoding_direction == "COL":
-            img = cv2.transpose(img)
-            img = cv2.flip(img, 0)
+            if os.path.exists(indexed[1]):
+                os.remove(indexed[1])
 
-        if rescale:
-            scale = dicom_data.spacing[0]
-            img = cv2.resize(img, (0, 0), fx=scale, fy=scale)
+    index.remove(deleted)
 
-        sq_img = get_square_crop(img, base_size=base_size, crop_size=crop_size)
-        clahe = cv2.createCLAHE(tileGridSize=(1, 1))
-        cl_img = clahe.apply(sq_img)
-        cv2.imwrite(img_path, cl_img)
+    if settings.USE_IMAGE_STORE:
+        # the image tensor of a patient is rewritten as a whole, so every file of a changed patient is converted
+        changed = sorted(file_path for file_path in file_stats if patient_dirs[file_path] in changed_dirs)
+
+        for patient_id in changed_patients:
+            image_store.delete_patient_images(patient_id)
+
+    patient_files = {}
+    for file_path in changed:
+        patient_files.setdefault(patient_dirs[file_path], []).append(file_path)
+
+    tasks = [(patient_dir, patient_files[patient_dir], target_dir, rescale, base_size, crop_size) for patient_dir in
+             sorted(patient_files, key=utils.get_patient_dir_sort_key)]
+
+    print("     " + str(len(changed)) + " fisiere noi sau modificate, " + str(len(deleted)) + " fisiere sterse")
+
+    worker_stats = {}
+    pool = None
+
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        results = pool.imap(ingest_patient, tasks)
+    else:
+        results = map(ingest_patient, tasks)
+
+    try:
+        for worker_id, records, elapsed in results:
+            for file_path, img_path, row in records:
+                size, mtime = file_stats[file_path]
+                index.put(file_path, patient_dirs[file_path], size, mtime, img_path, row)
+                changed_patients.add(row[0])
+
+            stats = worker_stats.setdefault(worker_id, [0, 0.])
+            stats[0] += len(records)
+            stats[1] += elapsed
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    index.commit()
+    index.set_changed_patients(changed_patients)
+    write_dicom_data(index.get_rows(utils.get_patient_dir_sort_key))
+    changed_patients = index.get_changed_patients()
+    index.close()
+
+    for worker_id, (worker_files, worker_time) in sorted(worker_stats.items()):
+        print("     worker " + str(worker_id) + " : " + str(worker_files) + " fisiere, " + str(
+            round(worker_files / max(worker_time, 1e-6), 2)) + " fisiere/sec")
+
+    return changed_patients
 
 
 if __name__ == "__main__":
-    convert_sax_images(rescale=True, base_size=256, crop_size=256)
-    create_csv_data()
-    enrich_dicom_csvdata()
+    incremental = len(sys.argv) > 1 and sys.argv[1] == "incremental"
+
+    changed_patients = ingest_sax_files(rescale=True, base_size=256, crop_size=256, incremental=incremental)
+    enrich_dicom_csvdata(patient_ids=changed_patients if incremental else None)
     enrich_traindata()
 
     train, val = sunnybrook.get_all_contours()
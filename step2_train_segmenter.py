@@ -7,33 +7,154 @@ import tensorflow as tf
 tf.logging.set_verbosity(tf.logging.ERROR)
 
 import sys
+import time
 import random
 import math
 import pickle
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 import functools
 import utils.sunnybrook as sunnybrook
+import utils.settings as settings
+import utils.utils as utils
+import utils.augmentation as augmentation
 
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import gen_nn_ops
+from tensorflow.tools.graph_transforms import TransformGraph
+
+# encoder blocks (the decoder mirrors them) and the width of the 7x7 fc_6 layer, None for no fc_6 layer
+ARCHITECTURES = {
+    'vgg': {'widths': [32, 64, 128, 256, 256], 'depths': [2, 2, 2, 3, 3], 'fc_width': 4096},
+    'vgg_slim': {'widths': [16, 32, 64, 128, 128], 'depths': [2, 2, 2, 3, 3], 'fc_width': 1024},
+    'vgg_nofc': {'widths': [32, 64, 128, 256, 256], 'depths': [2, 2, 2, 3, 3], 'fc_width': None},
+}
+
+
+def get_checkpoint_dir(architecture):
+    """
+    Get the checkpoint directory of an architecture, settings.SEGMENTER_DIR for settings.MODEL_NAME, vgg keeps
+    the original directory.
+    :param architecture: architecture name
+    :return: the checkpoint directory
+    """
+
+    if architecture == settings.MODEL_NAME:
+        return settings.SEGMENTER_DIR
+
+    if architecture == 'vgg':
+        return settings.SEGMENTER_BASE_DIR
+
+    return settings.SEGMENTER_BASE_DIR + architecture + '/'
+
+
+def get_architecture_flops(architecture, size=224):
+    """
+    Count the floating point operations of the convolutions and deconvolutions for one image, a multiply-add
+    counts as two.
+    :param architecture: architecture name
+    :param size: image size
+    :return: number of operations
+    """
+
+    spec = ARCHITECTURES[architecture]
+    widths = spec['widths']
+    flops = 2 * widths[0] * 2 * size * size
+    in_width = 1
+
+    for block, (width, depth) in enumerate(zip(widths, spec['depths'])):
+        out_width = widths[max(block - 1, 0)]
+
+        for layer in range(depth):
+            flops += 2 * 9 * in_width * width * size * size
+            flops += 2 * 9 * width * (out_width if layer == 0 else width) * size * size
+            in_width = width
+
+        size = (size + 1) // 2
+
+    if spec['fc_width'] is not None:
+        flops += 2 * 2 * 49 * in_width * spec['fc_width'] * size * size
+
+    return flops
+
+
+def get_architecture_parameters(architecture):
+    """
+    Count the trainable parameters of an architecture without building its graph, the layers are the ones
+    created by LVSegmentation.build.
+    :param architecture: architecture name
+    :return: number of parameters
+    """
+
+    spec = ARCHITECTURES[architecture]
+    widths = spec['widths']
+    parameters = 0
+    in_width = 1
+
+    for width, depth in zip(widths, spec['depths']):
+        for layer in range(depth):
+            parameters += 9 * in_width * width + width
+            in_width = width
+
+    if spec['fc_width'] is not None:
+        parameters += 49 * in_width * spec['fc_width'] + spec['fc_width']
+        parameters += 49 * in_width * spec['fc_width'] + in_width
+
+    for block, (width, depth) in enumerate(zip(widths, spec['depths'])):
+        out_width = widths[max(block - 1, 0)]
+
+        for layer in range(depth):
+            layer_width = out_width if layer == 0 else width
+            parameters += 9 * layer_width * width + layer_width
+
+    return parameters + 2 * widths[0] + 2
 
 
 class LVSegmentation(object):
-    def __init__(self, checkpoint_dir='data/segmenter/'):
+    def __init__(self, checkpoint_dir=None, restore=False, unpool_method=None, architecture=None,
+                 session_config=None, data_parallel=False):
         """
         First method
-        :param checkpoint_dir: the directory where will be saved all the value
+        :param checkpoint_dir: the directory where will be saved all the value, by default the directory of the
+        architecture
+        :param restore: restore the checkpoint now instead of at the first predict call
+        :param unpool_method: 'flat' or 'indices', by default settings.UNPOOL_METHOD. Both give the same output and
+        use the same variables, 'flat' builds much cheaper scatter indices
+        :param architecture: name from ARCHITECTURES, by default settings.MODEL_NAME
+        :param session_config: optional tf.ConfigProto, e.g. with the intra and inter op thread counts
+        :param data_parallel: also build the gradient outputs and the update from fed gradients used by
+        train_data_parallel, the variables stay the same
         """
 
-        self.build()
-        self.saver = tf.train.Saver(max_to_keep=40, keep_checkpoint_every_n_hours=1)
-        self.session = tf.Session()
-        self.session.run(tf.global_variables_initializer())
+        self.data_parallel = data_parallel
+        self.architecture = architecture or settings.MODEL_NAME
+
+        if self.architecture not in ARCHITECTURES:
+            raise ValueError('Unknown architecture ' + str(self.architecture))
+
+        if checkpoint_dir is None:
+            checkpoint_dir = get_checkpoint_dir(self.architecture)
+
+        self.unpool_method = unpool_method or settings.UNPOOL_METHOD
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+            self.build()
+            self.saver = tf.train.Saver(max_to_keep=40, keep_checkpoint_every_n_hours=1)
+            self.session = tf.Session(graph=self.graph, config=session_config)
+            self.session.run(tf.global_variables_initializer())
+
         self.checkpoint_dir = checkpoint_dir
+        self.restored = False
 
         self.loss_array = []
 
+        if restore:
+            self.restore_session()
+
     def restore_session(self):
         """
         Restore the session
@@ -52,6 +173,26 @@ class LVSegmentation(object):
         with open(self.checkpoint_dir + 'loss.pickle', 'rb') as f:
             self.loss_array = pickle.load(f)
 
+        self.restored = True
+
+    def reload(self):
+        """
+        Restore the latest checkpoint again, used when the checkpoint changed after the first predict call
+        :return: nothing
+        """
+
+        self.restore_session()
+
+    def close(self):
+        """
+        Close the session and release the graph
+        :return: nothing
+        """
+
+        self.session.close()
+        self.graph = None
+        self.restored = False
+
     def save_loss(self):
         """
         Save the loss score function
@@ -66,16 +207,39 @@ class LVSegmentation(object):
 
     def predict(self, images):
         """
-        Predict the value for specific images
+        Predict the value for specific images. The checkpoint is restored only at the first call.
         :param images: images
         :return: return the prediction
         """
 
-        self.restore_session()
+        if not self.restored:
+            self.restore_session()
 
         return self.prediction.eval(session=self.session, feed_dict={self.x: images})
 
-    def train(self, train_paths, epochs=40, batch_size=2, restore_session=False, learning_rate=1e-6):
+    def predict_with_counts(self, images, with_uncertain=False):
+        """
+        Predict the masks and count per image the left ventricle pixels and the uncertain pixels, the pixels with
+        a foreground probability in settings.UNCERTAIN_PROBABILITY_RANGE.
+        :param images: images
+        :param with_uncertain: count the uncertain pixels, this adds a softmax over the scores, otherwise the
+        uncertain counts are zero
+        :return: return the prediction, the pixel counts and the uncertain pixel counts
+        """
+
+        if not self.restored:
+            self.restore_session()
+
+        if with_uncertain:
+            return self.session.run([self.prediction, self.pixel_counts, self.uncertain_counts],
+                                    feed_dict={self.x: images})
+
+        prediction, pixel_counts = self.session.run([self.prediction, self.pixel_counts], feed_dict={self.x: images})
+
+        return prediction, pixel_counts, np.zeros(len(prediction), dtype=np.int32)
+
+    def train(self, train_paths, epochs=40, batch_size=2, restore_session=False, learning_rate=1e-6, log_steps=0,
+              augment=False):
         """
         Train the neural network.
         :param train_paths: path where will be saved the values
@@ -83,27 +247,68 @@ class LVSegmentation(object):
         :param batch_size: batch sieze
         :param restore_session: optional parameter for session restore
         :param learning_rate: learning rate for neural netwok
+        :param log_steps: print the mean loss of the last log_steps steps, 0 for no step logging
+        :param augment: augment every sample with a random crop, rotation and elastic deformation in background
+        threads, instead of one random crop per batch
         :return: nothing
         """
 
+        # the images and the labels are decoded once, in RAM or memory-mapped with settings.SEGMENTER_TRAIN_CACHE
+        train_images, train_labels = sunnybrook.cache_contours(train_paths, mmap_path=settings.SEGMENTER_TRAIN_CACHE)
+
         if restore_session:
             self.restore_session()
 
-        train_size = len(train_paths)
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        pipeline = None
+
+        if augment:
+            pipeline = augmentation.AugmentationPipeline(train_images, train_labels, batch_size, epochs)
+
+        try:
+            self.train_epochs(train_images, train_labels, epochs, batch_size, learning_rate, log_steps, pipeline)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+
+    def train_epochs(self, train_images, train_labels, epochs, batch_size, learning_rate, log_steps, pipeline=None):
+        """
+        The training loop
+        :param train_images: uint8 train images
+        :param train_labels: uint8 train labels
+        :param epochs: number of epochs
+        :param batch_size: batch size
+        :param learning_rate: learning rate for neural netwok
+        :param log_steps: print the mean loss of the last log_steps steps, 0 for no step logging
+        :param pipeline: optional AugmentationPipeline with the batches
+        :return: nothing
+        """
+
+        train_size = len(train_images)
 
         for epoch in range(epochs):
             total_loss = 0
+            log_loss = 0
 
-            for step in range(0, train_size, batch_size):
-                train_path = train_paths[step:step + batch_size]
-                _, images, labels = self.read_data(train_path)
+            for step_no, step in enumerate(range(0, train_size, batch_size)):
+                if pipeline is not None:
+                    images, labels = pipeline.next_batch()
+                else:
+                    _, images, labels = self.prepare_batch(train_images[step:step + batch_size],
+                                                           train_labels[step:step + batch_size])
 
-                self.train_step.run(session=self.session,
-                                    feed_dict={self.x: images, self.y: labels, self.rate: learning_rate})
-
-                loss = self.loss.eval(session=self.session, feed_dict={self.x: images, self.y: labels})
+                # one forward pass for the update and the loss, the loss is the one before the update
+                _, loss = self.session.run([self.train_step, self.loss],
+                                           feed_dict={self.x: images, self.y: labels, self.rate: learning_rate})
 
                 total_loss += loss
+                log_loss += loss
+
+                if log_steps > 0 and (step_no + 1) % log_steps == 0:
+                    print('Epoch {} - Step {} - Loss : {:.6f}'.format(epoch, step_no + 1, log_loss / log_steps))
+                    log_loss = 0
 
             print('Epoch {} - Loss : {:.6f}'.format(epoch, total_loss / train_size))
 
@@ -112,6 +317,45 @@ class LVSegmentation(object):
             self.loss_array.append(total_loss / train_size)
             self.save_loss()
 
+    def count_parameters(self):
+        """
+        Count the trainable parameters
+        :return: number of parameters
+        """
+
+        with self.graph.as_default():
+            return sum(int(np.prod(variable.get_shape().as_list())) for variable in tf.trainable_variables())
+
+    def export_inference_graph(self, graph_path=None, with_probability=False):
+        """
+        Write a frozen inference-only graph: the variables are replaced by constants, the optimizer, the loss and
+        the training placeholders are stripped and the constant subgraphs are folded.
+        :param graph_path: path of the graph file, by default inference_graph.pb in the checkpoint directory, i.e.
+        settings.SEGMENTER_GRAPH_PATH for settings.MODEL_NAME
+        :param with_probability: also export the foreground probability output
+        :return: nothing
+        """
+
+        if graph_path is None:
+            graph_path = self.checkpoint_dir + 'inference_graph.pb'
+
+        if not self.restored:
+            self.restore_session()
+
+        output_names = ['prediction', 'pixel_counts', 'uncertain_counts']
+        if with_probability:
+            output_names.append('foreground_probability')
+
+        graph_def = tf.graph_util.convert_variables_to_constants(self.session, self.graph.as_graph_def(),
+                                                                 output_names)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+        graph_def = TransformGraph(graph_def, ['images'], output_names,
+                                   ['strip_unused_nodes', 'fold_constants(ignore_errors=true)',
+                                    'sort_by_execution_order'])
+
+        graph_dir, graph_name = os.path.split(graph_path)
+        tf.train.write_graph(graph_def, graph_dir, graph_name, as_text=False)
+
     def read_data(self, paths):
         """
         Read data from a specific path
@@ -121,6 +365,16 @@ class LVSegmentation(object):
 
         images, labels = sunnybrook.export_all_contours(paths)
 
+        return self.prepare_batch(images, labels)
+
+    def prepare_batch(self, images, labels):
+        """
+        Random crop and normalize a batch
+        :param images: images
+        :param labels: labels
+        :return: return images before normalization, after normalization and true label
+        """
+
         crop_x = random.randint(0, 16)
         crop_y = random.randint(0, 16)
 
@@ -130,10 +384,7 @@ class LVSegmentation(object):
 
         before_normalization = images
 
-        images -= np.mean(images, dtype=np.float32)  # zero-centered
-        images /= np.std(images, dtype=np.float32)  # normalization
-
-        images = np.reshape(images, (-1, 224, 224, 1))
+        images = np.reshape(utils.normalize_batch(images), (-1, 224, 224, 1))
 
         return before_normalization, images, labels
 
@@ -152,71 +403,46 @@ class LVSegmentation(object):
         :return: nothing
         """
 
-        self.x = tf.placeholder(tf.float32, shape=(None, 224, 224, 1))
+        self.x = tf.placeholder(tf.float32, shape=(None, 224, 224, 1), name='images')
         self.y = tf.placeholder(tf.int64, shape=(None, 224, 224))
 
         expected = tf.expand_dims(self.y, -1)
         self.rate = tf.placeholder(tf.float32, shape=[])
 
-        conv_1_1 = self.conv_layer(self.x, [3, 3, 1, 32], 32, 'conv_1_1')
-        conv_1_2 = self.conv_layer(conv_1_1, [3, 3, 32, 32], 32, 'conv_1_2')
-
-        pool_1, pool_1_argmax = self.pool_layer(conv_1_2)
-
-        conv_2_1 = self.conv_layer(pool_1, [3, 3, 32, 64], 64, 'conv_2_1')
-        conv_2_2 = self.conv_layer(conv_2_1, [3, 3, 64, 64], 64, 'conv_2_2')
-
-        pool_2, pool_2_argmax = self.pool_layer(conv_2_2)
-
-        conv_3_1 = self.conv_layer(pool_2, [3, 3, 64, 128], 128, 'conv_3_1')
-        conv_3_2 = self.conv_layer(conv_3_1, [3, 3, 128, 128], 128, 'conv_3_2')
-
-        pool_3, pool_3_argmax = self.pool_layer(conv_3_2)
-
-        conv_4_1 = self.conv_layer(pool_3, [3, 3, 128, 256], 256, 'conv_4_1')
-        conv_4_2 = self.conv_layer(conv_4_1, [3, 3, 256, 256], 256, 'conv_4_2')
-        conv_4_3 = self.conv_layer(conv_4_2, [3, 3, 256, 256], 256, 'conv_4_2')
-
-        pool_4, pool_4_argmax = self.pool_layer(conv_4_3)
-
-        conv_5_1 = self.conv_layer(pool_4, [3, 3, 256, 256], 256, 'conv_5_1')
-        conv_5_2 = self.conv_layer(conv_5_1, [3, 3, 256, 256], 256, 'conv_5_2')
-        conv_5_3 = self.conv_layer(conv_5_2, [3, 3, 256, 256], 256, 'conv_5_3')
+        spec = ARCHITECTURES[self.architecture]
+        widths = spec['widths']
+        depths = spec['depths']
 
-        pool_5, pool_5_argmax = self.pool_layer(conv_5_3)
+        # the variables are created in the same order as the original vgg network to keep its checkpoints
+        hidden = self.x
+        in_width = 1
+        pool_argmaxes = []
 
-        fc_6 = self.conv_layer(pool_5, [7, 7, 256, 4096], 4096, 'fc_6')
+        for block, (width, depth) in enumerate(zip(widths, depths)):
+            for layer in range(depth):
+                hidden = self.conv_layer(hidden, [3, 3, in_width, width], width,
+                                         'conv_{}_{}'.format(block + 1, layer + 1))
+                in_width = width
 
-        deconv_fc_6 = self.deconv_layer(fc_6, [7, 7, 256, 4096], 256, 'fc6_deconv')
+            hidden, pool_argmax = self.pool_layer(hidden)
+            pool_argmaxes.append(pool_argmax)
 
-        unpool_5 = self.unpool_layer2x2(deconv_fc_6, pool_5_argmax)
+        if spec['fc_width'] is not None:
+            hidden = self.conv_layer(hidden, [7, 7, in_width, spec['fc_width']], spec['fc_width'], 'fc_6')
+            hidden = self.deconv_layer(hidden, [7, 7, in_width, spec['fc_width']], in_width, 'fc6_deconv')
 
-        deconv_5_3 = self.deconv_layer(unpool_5, [3, 3, 256, 256], 256, 'deconv_5_3')
-        deconv_5_2 = self.deconv_layer(deconv_5_3, [3, 3, 256, 256], 256, 'deconv_5_2')
-        deconv_5_1 = self.deconv_layer(deconv_5_2, [3, 3, 256, 256], 256, 'deconv_5_1')
+        for block in reversed(range(len(widths))):
+            width = widths[block]
+            out_width = widths[max(block - 1, 0)]
 
-        unpool_4 = self.unpool_layer2x2(deconv_5_1, pool_4_argmax)
+            hidden = self.unpool_layer2x2(hidden, pool_argmaxes[block])
 
-        deconv_4_3 = self.deconv_layer(unpool_4, [3, 3, 256, 256], 256, 'deconv_4_3')
-        deconv_4_2 = self.deconv_layer(deconv_4_3, [3, 3, 256, 256], 256, 'deconv_4_2')
-        deconv_4_1 = self.deconv_layer(deconv_4_2, [3, 3, 128, 256], 128, 'deconv_4_1')
+            for layer in reversed(range(depths[block])):
+                layer_width = out_width if layer == 0 else width
+                hidden = self.deconv_layer(hidden, [3, 3, layer_width, width], layer_width,
+                                           'deconv_{}_{}'.format(block + 1, layer + 1))
 
-        unpool_3 = self.unpool_layer2x2(deconv_4_1, pool_3_argmax)
-
-        deconv_3_2 = self.deconv_layer(unpool_3, [3, 3, 128, 128], 128, 'deconv_3_2')
-        deconv_3_1 = self.deconv_layer(deconv_3_2, [3, 3, 64, 128], 64, 'deconv_3_1')
-
-        unpool_2 = self.unpool_layer2x2(deconv_3_1, pool_2_argmax)
-
-        deconv_2_2 = self.deconv_layer(unpool_2, [3, 3, 64, 64], 64, 'deconv_2_2')
-        deconv_2_1 = self.deconv_layer(deconv_2_2, [3, 3, 32, 64], 32, 'deconv_2_1')
-
-        unpool_1 = self.unpool_layer2x2(deconv_2_1, pool_1_argmax)
-
-        deconv_1_2 = self.deconv_layer(unpool_1, [3, 3, 32, 32], 32, 'deconv_1_2')
-        deconv_1_1 = self.deconv_layer(deconv_1_2, [3, 3, 32, 32], 32, 'deconv_1_1')
-
-        score_1 = self.deconv_layer(deconv_1_1, [1, 1, 2, 32], 2, 'score_1')
+        score_1 = self.deconv_layer(hidden, [1, 1, 2, widths[0]], 2, 'score_1')
 
         logits = tf.reshape(score_1, (-1, 2))
         cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits,
@@ -225,9 +451,27 @@ class LVSegmentation(object):
 
         self.loss = tf.reduce_mean(cross_entropy, name='x_entropy_mean')
 
-        self.train_step = tf.train.AdamOptimizer(self.rate).minimize(self.loss)
+        optimizer = tf.train.AdamOptimizer(self.rate)
+        gradients_and_variables = optimizer.compute_gradients(self.loss)
+        self.train_step = optimizer.apply_gradients(gradients_and_variables)
+
+        if self.data_parallel:
+            # the same optimizer reuses its Adam slots, so the checkpoints stay compatible
+            self.gradients = [gradient for gradient, _ in gradients_and_variables]
+            self.gradient_inputs = [tf.placeholder(tf.float32, shape=variable.get_shape()) for _, variable in
+                                    gradients_and_variables]
+            self.apply_step = optimizer.apply_gradients(
+                zip(self.gradient_inputs, [variable for _, variable in gradients_and_variables]))
 
-        self.prediction = tf.argmax(tf.reshape(tf.nn.softmax(logits), tf.shape(score_1)), dimension=3)
+        # softmax doesn't change the argmax, the hard mask is computed on the scores
+        self.prediction = tf.argmax(score_1, axis=3, name='prediction')
+        self.foreground_probability = tf.identity(tf.nn.softmax(score_1)[:, :, :, 1], name='foreground_probability')
+
+        low_probability, high_probability = settings.UNCERTAIN_PROBABILITY_RANGE
+        uncertain = tf.logical_and(self.foreground_probability > low_probability,
+                                   self.foreground_probability < high_probability)
+        self.pixel_counts = tf.reduce_sum(tf.cast(self.prediction, tf.int32), axis=[1, 2], name='pixel_counts')
+        self.uncertain_counts = tf.reduce_sum(tf.cast(uncertain, tf.int32), axis=[1, 2], name='uncertain_counts')
 
     def weight_variable(self, shape, stddev):
         """
@@ -324,6 +568,43 @@ class LVSegmentation(object):
         return tf.stack(output_list)
 
     def unpool_layer2x2(self, bottom, argmax):
+        """
+        Unpool layer, implemented with the method selected by unpool_method
+        :param bottom: start of the data
+        :param argmax: argmax of the corespondent pool layer
+        :return: the output of the unpool layer
+        """
+
+        if self.unpool_method == 'flat':
+            return self.unpool_layer2x2_flat(bottom, argmax)
+
+        if self.unpool_method == 'indices':
+            return self.unpool_layer2x2_indices(bottom, argmax)
+
+        raise ValueError('Unknown unpool method ' + str(self.unpool_method))
+
+    def unpool_layer2x2_flat(self, bottom, argmax):
+        """
+        Unpool layer scattering into the flattened output. The argmax of max_pool_with_argmax is already the flat
+        index (y * width + x) * channels + c inside one image, only the offset of the image in the batch is added.
+        :param bottom: start of the data
+        :param argmax: argmax of the corespondent pool layer
+        :return: the output of the unpool layer
+        """
+
+        bottom_shape = tf.shape(bottom)
+        top_shape = tf.stack([bottom_shape[0], bottom_shape[1] * 2, bottom_shape[2] * 2, bottom_shape[3]])
+        image_size = tf.to_int64(top_shape[1] * top_shape[2] * top_shape[3])
+
+        batch_offset = tf.reshape(tf.range(tf.to_int64(bottom_shape[0])) * image_size, [-1, 1, 1, 1])
+        indices = tf.reshape(argmax % image_size + batch_offset, [-1, 1])
+        values = tf.reshape(bottom, [-1])
+
+        top = tf.scatter_nd(indices, values, tf.reshape(tf.to_int64(bottom_shape[0]) * image_size, [1]))
+
+        return tf.reshape(top, top_shape)
+
+    def unpool_layer2x2_indices(self, bottom, argmax):
         """
         Unpool layer
         :param bottom: start of the data
@@ -366,22 +647,462 @@ class LVSegmentation(object):
         return tf.scatter_nd(indices, values, tf.to_int64(top_shape))
 
 
+def data_parallel_worker(worker_no, workers, cache_path, init_path, checkpoint_dir, architecture, epochs, batch_size,
+                         learning_rate, restore_session, intra_op_threads, sum_buffer, chunk_locks, chunk_steps,
+                         losses_buffer, epoch_times_buffer, barrier):
+    """
+    One process of train_data_parallel. Every step each worker adds its gradients in place to the shared sum
+    buffer, one chunk at a time under the lock of the chunk, and all the workers apply the averaged sum so they
+    keep the same weights. The first worker adding to a chunk in a step overwrites the sum of the previous step.
+    :param worker_no: worker number, worker 0 saves the checkpoints
+    :param workers: number of workers
+    :param cache_path: path prefix of the memory-mapped training set written by sunnybrook.cache_contours
+    :param init_path: checkpoint path used to share the initial weights of worker 0
+    :param checkpoint_dir: checkpoint directory
+    :param architecture: architecture name
+    :param epochs: number of epochs
+    :param batch_size: batch size per worker
+    :param learning_rate: learning rate for neural netwok
+    :param restore_session: start from the latest checkpoint
+    :param intra_op_threads: TensorFlow threads of the worker
+    :param sum_buffer: shared float32 buffer with the sum of the gradients of the workers
+    :param chunk_locks: one lock per chunk of the sum buffer
+    :param chunk_steps: shared buffer with the last step added to every chunk
+    :param losses_buffer: shared float64 buffer with the loss of every worker
+    :param epoch_times_buffer: shared float64 buffer where worker 0 writes the seconds of every epoch
+    :param barrier: barrier of the workers
+    :return: nothing
+    """
+
+    random.seed(1301 + worker_no)
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=1)
+    segmenter = LVSegmentation(checkpoint_dir=checkpoint_dir, architecture=architecture,
+                               session_config=session_config, data_parallel=True)
+
+    if restore_session:
+        segmenter.restore_session()
+    elif worker_no == 0:
+        segmenter.saver.save(segmenter.session, init_path)
+
+    barrier.wait()
+
+    if not restore_session and worker_no != 0:
+        segmenter.saver.restore(segmenter.session, init_path)
+
+    train_images = np.load(cache_path + '_images.npy', mmap_mode='r')
+    train_labels = np.load(cache_path + '_labels.npy', mmap_mode='r')
+    train_size = len(train_images)
+
+    gradients_sum = np.frombuffer(sum_buffer, dtype=np.float32)
+    losses = np.frombuffer(losses_buffer, dtype=np.float64)
+    epoch_times = np.frombuffer(epoch_times_buffer, dtype=np.float64)
+
+    shapes = [gradient_input.get_shape().as_list() for gradient_input in segmenter.gradient_inputs]
+    offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+    bounds = np.linspace(0, offsets[-1], len(chunk_locks) + 1).astype(np.int64)
+    gradient = np.empty(offsets[-1], dtype=np.float32)
+    global_step = 0
+
+    if worker_no == 0 and not os.path.exists(segmenter.checkpoint_dir):
+        os.makedirs(segmenter.checkpoint_dir)
+
+    for epoch in range(epochs):
+        start_time = time.time()
+        total_loss = 0
+
+        for step in range(0, train_size, workers * batch_size):
+            # the last global batch wraps around so every worker has a full batch
+            indices = np.arange(step + worker_no * batch_size, step + (worker_no + 1) * batch_size) % train_size
+            _, images, labels = segmenter.prepare_batch(train_images[indices], train_labels[indices])
+
+            step_gradients, losses[worker_no] = segmenter.session.run([segmenter.gradients, segmenter.loss],
+                                                                      feed_dict={segmenter.x: images,
+                                                                                 segmenter.y: labels})
+
+            for step_gradient, offset in zip(step_gradients, offsets):
+                gradient[offset:offset + step_gradient.size] = step_gradient.ravel()
+
+            global_step += 1
+
+            # every worker starts with a different chunk so the workers rarely wait for the same lock
+            for chunk in np.roll(np.arange(len(chunk_locks)), -worker_no):
+                chunk_start, chunk_end = bounds[chunk], bounds[chunk + 1]
+
+                with chunk_locks[chunk]:
+                    if chunk_steps[chunk] != global_step:
+                        gradients_sum[chunk_start:chunk_end] = gradient[chunk_start:chunk_end]
+                        chunk_steps[chunk] = global_step
+                    else:
+                        gradients_sum[chunk_start:chunk_end] += gradient[chunk_start:chunk_end]
+
+            barrier.wait()
+
+            total_loss += losses.sum()
+
+            feed_dict = {segmenter.rate: learning_rate}
+            for gradient_input, shape, offset in zip(segmenter.gradient_inputs, shapes, offsets):
+                feed_dict[gradient_input] = gradients_sum[offset:offset + int(np.prod(shape))].reshape(shape) / workers
+
+            segmenter.session.run(segmenter.apply_step, feed_dict=feed_dict)
+
+            # the sum is overwritten by the next step only when every worker has applied it
+            barrier.wait()
+
+        if worker_no == 0:
+            epoch_times[epoch] = time.time() - start_time
+            print('Epoch {} - Loss : {:.6f} - Time : {:.2f}s'.format(epoch, total_loss / train_size,
+                                                                     epoch_times[epoch]))
+
+            segmenter.saver.save(segmenter.session, segmenter.checkpoint_dir + 'model', global_step=epoch)
+
+            segmenter.loss_array.append(total_loss / train_size)
+            segmenter.save_loss()
+
+    segmenter.close()
+
+
+def train_data_parallel(train_paths, workers=None, epochs=40, batch_size=2, restore_session=False, learning_rate=1e-6,
+                        architecture=None, intra_op_threads=None, checkpoint_dir=None, cache_path=None):
+    """
+    Synchronous data-parallel training in local worker processes. The gradients are summed every step in a
+    single shared buffer, averaged and applied by every worker, worker 0 saves the checkpoints.
+    :param train_paths: the train contours, ignored when cache_path is given
+    :param workers: number of worker processes, by default settings.TRAIN_WORKERS
+    :param epochs: number of epochs
+    :param batch_size: batch size per worker
+    :param restore_session: start from the latest checkpoint
+    :param learning_rate: learning rate for neural netwok
+    :param architecture: name from ARCHITECTURES, by default settings.MODEL_NAME
+    :param intra_op_threads: TensorFlow threads per worker, by default the CPUs divided by the workers
+    :param checkpoint_dir: checkpoint directory, by default the directory of the architecture
+    :param cache_path: optional path prefix of a training set already written by sunnybrook.cache_contours
+    :return: seconds of every epoch
+    """
+
+    workers = workers or settings.TRAIN_WORKERS
+    architecture = architecture or settings.MODEL_NAME
+    intra_op_threads = intra_op_threads or max(1, multiprocessing.cpu_count() // workers)
+    checkpoint_dir = checkpoint_dir or get_checkpoint_dir(architecture)
+
+    work_dir = tempfile.mkdtemp(prefix='segmenter_train_')
+
+    try:
+        if cache_path is None:
+            cache_path = settings.SEGMENTER_TRAIN_CACHE or os.path.join(work_dir, 'train')
+            sunnybrook.cache_contours(train_paths, mmap_path=cache_path)
+
+        context = multiprocessing.get_context('spawn')
+        sum_buffer = context.RawArray('f', get_architecture_parameters(architecture))
+        chunk_locks = [context.Lock() for _ in range(workers)]
+        chunk_steps = context.RawArray('l', workers)
+        losses_buffer = context.RawArray('d', workers)
+        epoch_times_buffer = context.RawArray('d', epochs)
+        barrier = context.Barrier(workers)
+
+        processes = [context.Process(target=data_parallel_worker,
+                                     args=(worker_no, workers, cache_path, os.path.join(work_dir, 'init'),
+                                           checkpoint_dir, architecture, epochs, batch_size, learning_rate,
+                                           restore_session, intra_op_threads, sum_buffer, chunk_locks, chunk_steps,
+                                           losses_buffer, epoch_times_buffer, barrier))
+                     for worker_no in range(workers)]
+
+        for process in processes:
+            process.start()
+
+        # a failed worker breaks the barrier so the others don't wait for it forever
+        while any(process.is_alive() for process in processes):
+            for process in processes:
+                process.join(timeout=1)
+
+                if process.exitcode not in (None, 0):
+                    barrier.abort()
+
+        failed = [worker_no for worker_no, process in enumerate(processes) if process.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError('Training workers ' + str(failed) + ' failed')
+
+        return list(epoch_times_buffer)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def verify_unpool_methods(images, checkpoint_dir=None):
+    """
+    Restore the checkpoint with both unpool methods and compare the outputs on the same images.
+    :param images: images prepared with prepare_evaluation_images
+    :param checkpoint_dir: the checkpoint directory, by default the directory of settings.MODEL_NAME
+    :return: maximum absolute difference of the foreground probabilities and number of different mask pixels
+    """
+
+    outputs = []
+
+    for unpool_method in ['indices', 'flat']:
+        segmenter = LVSegmentation(checkpoint_dir=checkpoint_dir, restore=True, unpool_method=unpool_method)
+        outputs.append(segmenter.session.run([segmenter.foreground_probability, segmenter.prediction],
+                                             feed_dict={segmenter.x: images}))
+        segmenter.close()
+
+    max_difference = float(np.abs(outputs[0][0] - outputs[1][0]).max())
+    different_pixels = int((outputs[0][1] != outputs[1][1]).sum())
+
+    return max_difference, different_pixels
+
+
+def profile_architectures(batch_size=8, runs=5):
+    """
+    Measure the parameters, the FLOPs and the CPU throughput of every architecture with random weights.
+    :param batch_size: batch size
+    :param runs: number of timed batches
+    :return: list with the architecture name, parameters, FLOPs per image and images per second
+    """
+
+    images = np.random.randn(batch_size, 224, 224, 1).astype(np.float32)
+    results = []
+
+    for architecture in sorted(ARCHITECTURES):
+        segmenter = LVSegmentation(architecture=architecture)
+        segmenter.session.run(segmenter.prediction, feed_dict={segmenter.x: images})
+
+        start_time = time.time()
+        for _ in range(runs):
+            segmenter.session.run(segmenter.prediction, feed_dict={segmenter.x: images})
+        elapsed = time.time() - start_time
+
+        results.append((architecture, segmenter.count_parameters(), get_architecture_flops(architecture),
+                        batch_size * runs / elapsed))
+        segmenter.close()
+
+    return results
+
+
+def is_graph_outdated(graph_path, checkpoint_dir=None):
+    """
+    Check if a checkpoint was saved after an exported graph was written.
+    :param graph_path: path of the graph file
+    :param checkpoint_dir: the checkpoint directory, by default the directory of settings.MODEL_NAME
+    :return: True if the graph is older than the latest checkpoint
+    """
+
+    checkpoint_state = (checkpoint_dir or get_checkpoint_dir(settings.MODEL_NAME)) + 'checkpoint'
+
+    return os.path.exists(checkpoint_state) and os.path.getmtime(checkpoint_state) > os.path.getmtime(graph_path)
+
+
+def load_graph_def(graph_path):
+    """
+    Read a frozen graph file.
+    :param graph_path: path of the graph file
+    :return: the graph definition
+    """
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(graph_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    return graph_def
+
+
+def count_graph_ops(graph_def):
+    """
+    Count the quantized and the float compute ops of a frozen graph.
+    :param graph_def: the graph definition
+    :return: dictionary with the number of quantized ops and the number of float ops per type
+    """
+
+    float_ops = ['Conv2D', 'Conv2DBackpropInput', 'MatMul', 'MaxPool', 'MaxPoolWithArgmax', 'ScatterNd']
+    counts = {"quantized": 0, "float": {}}
+
+    for node in graph_def.node:
+        if node.op.startswith('Quantized'):
+            counts["quantized"] += 1
+        elif node.op in float_ops:
+            counts["float"][node.op] = counts["float"].get(node.op, 0) + 1
+
+    return counts
+
+
+def prepare_evaluation_images(images):
+    """
+    Center crop and normalize Sunnybrook images for prediction.
+    :param images: images returned by sunnybrook.export_all_contours
+    :return: array with the shape (-1, 224, 224, 1)
+    """
+
+    images = images[:, 8:8 + 224, 8:8 + 224]
+    images = np.array([utils.normalize_image(image) for image in images])
+
+    return np.reshape(images, (-1, 224, 224, 1))
+
+
+def quantize_inference_graph(calibration_images, graph_path=None, quantized_graph_path=None, batch_size=8):
+    """
+    Write an int8 version of the frozen inference graph. The weights are stored in eight bits and quantize_nodes
+    replaces the ops that have a quantized kernel, i.e. the encoder convolutions and relus, the requantization
+    ranges are measured on the calibration images and frozen in the graph. The rest stays in float: the
+    conv2d_transpose of the decoder, the max_pool_with_argmax of the encoder and the scatter_nd of the unpooling
+    have no quantized kernel and run between dequantize and quantize ops, so only the encoder convolutions are
+    faster. Use count_graph_ops to see the split.
+    :param calibration_images: images prepared with prepare_evaluation_images
+    :param graph_path: the float32 frozen graph, by default settings.SEGMENTER_GRAPH_PATH
+    :param quantized_graph_path: the int8 graph, by default settings.SEGMENTER_QUANTIZED_GRAPH_PATH
+    :param batch_size: calibration batch size
+    :return: nothing
+    """
+
+    if graph_path is None:
+        graph_path = settings.SEGMENTER_GRAPH_PATH
+
+    if quantized_graph_path is None:
+        quantized_graph_path = settings.SEGMENTER_QUANTIZED_GRAPH_PATH
+
+    graph_def = load_graph_def(graph_path)
+    output_names = [name for name in ['prediction', 'pixel_counts', 'uncertain_counts', 'foreground_probability'] if
+                    name in [node.name for node in graph_def.node]]
+
+    graph_def = TransformGraph(graph_def, ['images'], output_names,
+                               ['quantize_weights', 'quantize_nodes', 'strip_unused_nodes',
+                                'sort_by_execution_order'])
+
+    range_names = [node.name for node in graph_def.node if node.op == 'RequantizationRange']
+    log_lines = []
+
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        range_tensors = [(graph.get_tensor_by_name(name + ':0'), graph.get_tensor_by_name(name + ':1')) for name in
+                         range_names]
+
+        with tf.Session(graph=graph) as session:
+            for i in range(0, len(calibration_images), batch_size):
+                ranges = session.run(range_tensors,
+                                     feed_dict={'images:0': calibration_images[i:i + batch_size]})
+
+                for name, (range_min, range_max) in zip(range_names, ranges):
+                    log_lines.append(';' + name + '__print__;__requant_min_max:[' + str(range_min) + '][' + str(
+                        range_max) + ']')
+
+    log_path = quantized_graph_path + '.ranges.txt'
+    with open(log_path, 'w') as f:
+        f.write('\n'.join(log_lines) + '\n')
+
+    graph_def = TransformGraph(graph_def, ['images'], output_names,
+                               ['freeze_requantization_ranges(min_max_log_file="' + log_path + '")',
+                                'strip_unused_nodes', 'sort_by_execution_order'])
+
+    graph_dir, graph_name = os.path.split(quantized_graph_path)
+    tf.train.write_graph(graph_def, graph_dir, graph_name, as_text=False)
+
+
+class FrozenLVSegmentation(object):
+    def __init__(self, graph_path=None, session_config=None):
+        """
+        Load the frozen inference graph written by LVSegmentation.export_inference_graph or its int8 version
+        written by quantize_inference_graph.
+        :param graph_path: path of the graph file, by default settings.SEGMENTER_GRAPH_PATH
+        :param session_config: optional tf.ConfigProto, e.g. with the intra and inter op thread counts
+        """
+
+        if graph_path is None:
+            graph_path = settings.SEGMENTER_GRAPH_PATH
+
+        graph_def = load_graph_def(graph_path)
+
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.x = self.graph.get_tensor_by_name('images:0')
+        self.prediction = self.graph.get_tensor_by_name('prediction:0')
+        node_names = [node.name for node in graph_def.node]
+
+        self.foreground_probability = None
+        self.pixel_counts = None
+        self.uncertain_counts = None
+
+        if 'foreground_probability' in node_names:
+            self.foreground_probability = self.graph.get_tensor_by_name('foreground_probability:0')
+
+        if 'pixel_counts' in node_names:
+            self.pixel_counts = self.graph.get_tensor_by_name('pixel_counts:0')
+
+        if 'uncertain_counts' in node_names:
+            self.uncertain_counts = self.graph.get_tensor_by_name('uncertain_counts:0')
+
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+    def predict(self, images):
+        """
+        Predict the value for specific images
+        :param images: images
+        :return: return the prediction
+        """
+
+        return self.session.run(self.prediction, feed_dict={self.x: images})
+
+    def predict_with_counts(self, images, with_uncertain=False):
+        """
+        Predict the masks with the left ventricle and uncertain pixel counts per image. The counts missing from
+        graphs exported before the count outputs existed are computed from the fetched outputs.
+        :param images: images
+        :param with_uncertain: count the uncertain pixels, this adds a softmax over the scores, otherwise the
+        uncertain counts are zero
+        :return: return the prediction, the pixel counts and the uncertain pixel counts
+        """
+
+        if with_uncertain and self.pixel_counts is not None and self.uncertain_counts is not None:
+            return self.session.run([self.prediction, self.pixel_counts, self.uncertain_counts],
+                                    feed_dict={self.x: images})
+
+        if not with_uncertain or self.foreground_probability is None:
+            if self.pixel_counts is not None:
+                prediction, pixel_counts = self.session.run([self.prediction, self.pixel_counts],
+                                                            feed_dict={self.x: images})
+            else:
+                prediction = self.session.run(self.prediction, feed_dict={self.x: images})
+                pixel_counts = (prediction == 1).sum(axis=(1, 2))
+
+            return prediction, pixel_counts, np.zeros(len(prediction), dtype=np.int32)
+
+        prediction, probability = self.session.run([self.prediction, self.foreground_probability],
+                                                   feed_dict={self.x: images})
+        low_probability, high_probability = settings.UNCERTAIN_PROBABILITY_RANGE
+        uncertain = (probability > low_probability) & (probability < high_probability)
+
+        return prediction, (prediction == 1).sum(axis=(1, 2)), uncertain.sum(axis=(1, 2))
+
+    def close(self):
+        """
+        Close the session and release the graph
+        :return: nothing
+        """
+
+        self.session.close()
+        self.graph = None
+
+
 if __name__ == '__main__':
     train, val = sunnybrook.get_all_contours()
-    segmenter = LVSegmentation()
 
-    if len(sys.argv) != 2:
-        print('The program must be run as : python3.5 step2_train_segmenter.py [train|predict]')
+    if len(sys.argv) < 2:
+        print('The program must be run as : python3.5 step2_train_segmenter.py [train|predict|export [probability]|train_parallel [workers]|quantize|verify_unpool|profile]')
         sys.exit(2)
     else:
         if sys.argv[1] == 'train':
             print('Run Train .....')
 
-            segmenter.train(train)
+            segmenter = LVSegmentation()
+            segmenter.train(train, log_steps=settings.TRAIN_LOG_STEPS, augment=settings.AUGMENT_TRAINING)
+
+        elif sys.argv[1] == 'train_parallel':
+            print('Run Train Parallel .....')
+
+            train_data_parallel(train, workers=int(sys.argv[2]) if len(sys.argv) > 2 else None)
 
         elif sys.argv[1] == 'predict':
             print('Run Predict .....')
 
+            segmenter = LVSegmentation()
             images, prepoces_images, labels = segmenter.read_data(val)
             predictions = segmenter.predict(prepoces_images)
 
@@ -396,7 +1117,43 @@ if __name__ == '__main__':
                 plt.imshow(image, cmap='gray')
                 plt.show()
 
+        elif sys.argv[1] == 'export':
+            print('Run Export .....')
+
+            segmenter = LVSegmentation()
+            segmenter.export_inference_graph(with_probability='probability' in sys.argv[2:])
+
+        elif sys.argv[1] == 'quantize':
+            print('Run Quantize .....')
+
+            if not os.path.exists(settings.SEGMENTER_GRAPH_PATH) or is_graph_outdated(settings.SEGMENTER_GRAPH_PATH):
+                LVSegmentation().export_inference_graph(with_probability=True)
+
+            calibration_ctrs = random.sample(train, min(settings.QUANTIZATION_CALIBRATION_IMAGES, len(train)))
+            calibration_images, _ = sunnybrook.export_all_contours(calibration_ctrs)
+            quantize_inference_graph(prepare_evaluation_images(calibration_images))
+            print(count_graph_ops(load_graph_def(settings.SEGMENTER_QUANTIZED_GRAPH_PATH)))
+
+        elif sys.argv[1] == 'verify_unpool':
+            print('Run Verify Unpool .....')
+
+            val_images, _ = sunnybrook.export_all_contours(val)
+            max_difference, different_pixels = verify_unpool_methods(prepare_evaluation_images(val_images))
+
+            print('Max probability difference : {:.9f} - Different mask pixels : {}'.format(max_difference,
+                                                                                            different_pixels))
+
+            if max_difference != 0.0 or different_pixels != 0:
+                sys.exit(1)
+
+        elif sys.argv[1] == 'profile':
+            print('Run Profile .....')
+
+            for architecture, parameters, flops, images_per_sec in profile_architectures():
+                print('{} - Parameters : {} - GFLOPs per image : {:.2f} - Images/sec : {:.2f}'.format(
+                    architecture, parameters, flops / 1e9, images_per_sec))
 
         else:
-            print('The available options for this script are : train, evaluate and predict')
+            print('The available options for this script are : train, train_parallel, predict, export, quantize, '
+                  'verify_unpool and profile')
             sys.exit(2)
@@ -3,6 +3,9 @@ import math
 import ntpath
 import os.path
 import shutil
+import collections
+import concurrent.futures
+import functools
 import cv2
 import numpy
 import pandas
@@ -10,7 +13,8 @@ import numpy as np
 
 import utils.settings as settings
 import utils.utils as utils
-from step2_train_segmenter import LVSegmentation
+import utils.image_store as image_store
+from step2_train_segmenter import LVSegmentation, FrozenLVSegmentation, is_graph_outdated
 
 MODEL_NAME = settings.MODEL_NAME
 CROP_SIZE = settings.CROP_SIZE
@@ -26,27 +30,51 @@ PROCESS_IMAGES = True
 SEGMENT_IMAGES = True
 COUNT_PIXELS = True
 COMPUTE_VOLUMES = True
+SAVE_OVERLAYS = True
 
 PREDICTION_FILENAME = "prediction_raw_" + MODEL_NAME + ".csv"
 LOW_CONFIDENCE_PIXEL_THRESHOLD = 200
+PATIENT_BATCH_SIZE = 10
 
 current_debug_line = []
 global_dia_errors = []
 global_sys_errors = []
 
 
-def prepare_patient_images(patient_id, intermediate_crop=0):
+def load_cropped_image(source, intermediate_crop=0, target_path=None):
     """
-    Prepare patient images. Create the patient folder. Crop the patient image if it's necessary 
-    and save it in a new directory.
+    Read and crop one patient image, called by the SegmentationScheduler prefetch threads.
+    :param source: path of the preprocessed PNG or image view of the image store
+    :param intermediate_crop: optional parameter
+    :param target_path: optional path where the cropped image is written
+    :return: the cropped image
+    """
+
+    if isinstance(source, str):
+        source = cv2.imread(source, cv2.IMREAD_GRAYSCALE)
+
+    cropped_img = utils.prepare_cropped_sax_image(source, clahe=True, intermediate_crop=intermediate_crop, rotate=0)
+
+    if target_path is not None:
+        cv2.imwrite(target_path, cropped_img)
+
+    return cropped_img
+
+
+def prepare_patient_images(patient_id, intermediate_crop=0, lazy=True):
+    """
+    Prepare patient images. Create the patient folder and list the images, with lazy the images are read, cropped
+    and saved in the new directory by the loaders when the SegmentationScheduler prepares their batch, otherwise
+    they are saved now. With settings.USE_IMAGE_STORE the images are views of the memory-mapped patient tensor
+    and are not saved.
     :param patient_id: the patient id.
     :param intermediate_crop: optional parameter
-    :return: nothing
+    :param lazy: leave the cropping to the loaders, only when the images are segmented afterwards
+    :return: list with the file name and the loader of the cropped image, or the path of the saved image
     """
 
-    file_lst = []
+    images = []
     prefix = str(patient_id).rjust(4, '0')
-    src_files = utils.get_files(settings.BASE_PREPROCESSEDIMAGES_DIR, prefix + "*.png")
 
     patient_dir = utils.get_pred_patient_dir(patient_id)
     utils.create_dir_if_not_exists(patient_dir)
@@ -54,90 +82,273 @@ def prepare_patient_images(patient_id, intermediate_crop=0):
     utils.create_dir_if_not_exists(patient_img_dir)
     utils.delete_files(patient_img_dir, "*.png")
 
-    dummy = numpy.zeros((settings.TARGET_SIZE, settings.TARGET_SIZE))
-    cv2.imwrite(patient_img_dir + "dummy_overlay.png", dummy)
+    if settings.USE_IMAGE_STORE:
+        for file_name, image in image_store.enumerate_patient_images(patient_id):
+            images.append((file_name, functools.partial(load_cropped_image, image,
+                                                        intermediate_crop=intermediate_crop)))
 
-    for src_path in src_files:
+        return images
+
+    for src_path in utils.get_files(settings.BASE_PREPROCESSEDIMAGES_DIR, prefix + "*.png"):
         file_name = ntpath.basename(src_path)
-        org_img = cv2.imread(src_path, cv2.IMREAD_GRAYSCALE)
-        cropped_img = utils.prepare_cropped_sax_image(org_img, clahe=True, intermediate_crop=intermediate_crop,
-                                                      rotate=0)
 
-        cv2.imwrite(patient_img_dir + file_name, cropped_img)
-        file_lst.append([file_name, "dummy_overlay.png"])
+        if lazy:
+            images.append((file_name, functools.partial(load_cropped_image, src_path,
+                                                        intermediate_crop=intermediate_crop,
+                                                        target_path=patient_img_dir + file_name)))
+        else:
+            load_cropped_image(src_path, intermediate_crop=intermediate_crop, target_path=patient_img_dir + file_name)
+            images.append((file_name, patient_img_dir + file_name))
+
+    dummy = numpy.zeros((settings.TARGET_SIZE, settings.TARGET_SIZE))
+    cv2.imwrite(patient_img_dir + "dummy_overlay.png", dummy)
 
     with open(patient_img_dir + "pred.lst", "w") as f:
         writer = csv.writer(f, delimiter='\t')
-        writer.writerows(file_lst)
+        writer.writerows([file_name, "dummy_overlay.png"] for file_name, _ in images)
 
+    return images
 
-def predict_overlays_patient(patient_id, save_transparents=False):
+
+def create_segmenter():
     """
-    Predict the left ventricle with neural network.
+    Create the segmenter, the frozen inference graph is used when it was exported and the int8 graph when
+    settings.USE_QUANTIZED_SEGMENTER is set. A frozen graph older than the latest checkpoint is exported again,
+    an outdated int8 graph is skipped because it needs a new calibration.
+    :return: FrozenLVSegmentation or LVSegmentation with the checkpoint restored
+    """
+
+    quantized_graph_path = settings.SEGMENTER_QUANTIZED_GRAPH_PATH
+
+    if settings.USE_QUANTIZED_SEGMENTER and os.path.exists(quantized_graph_path):
+        float_graph_newer = os.path.exists(settings.SEGMENTER_GRAPH_PATH) and \
+            os.path.getmtime(settings.SEGMENTER_GRAPH_PATH) > os.path.getmtime(quantized_graph_path)
+
+        if float_graph_newer or is_graph_outdated(quantized_graph_path):
+            print("   > Graful int8 " + quantized_graph_path + " este mai vechi decat modelul si nu este folosit")
+        else:
+            return FrozenLVSegmentation(quantized_graph_path)
+
+    if not os.path.exists(settings.SEGMENTER_GRAPH_PATH):
+        return LVSegmentation(restore=True)
+
+    if is_graph_outdated(settings.SEGMENTER_GRAPH_PATH):
+        print("   > Exportarea grafului " + settings.SEGMENTER_GRAPH_PATH + " pentru ultimul checkpoint")
+
+        segmenter = LVSegmentation(restore=True)
+        segmenter.export_inference_graph()
+        segmenter.close()
+
+    return FrozenLVSegmentation(settings.SEGMENTER_GRAPH_PATH)
+
+
+def prepare_batch(batch):
+    """
+    Decode and normalize a batch of the SegmentationScheduler.
+    :param batch: list with the owner, the file name and the image, the path of a grayscale PNG or a loader
+    returning the image
+    :return: list with the owner, the file name and the decoded image, array with the normalized images
+    """
+
+    items = []
+
+    for owner, file_name, image in batch:
+        if isinstance(image, str):
+            image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        elif callable(image):
+            image = image()
+
+        items.append((owner, file_name, image))
+
+    images = np.array([utils.normalize_image(image) for _, _, image in items])
+
+    return items, np.reshape(images, (-1, 224, 224, 1))
+
+
+class SegmentationScheduler(object):
+    def __init__(self, segmenter, max_batch_size=None, prefetch_batches=None, with_uncertain=None):
+        """
+        Pack the images of one or more patients in batches for the segmenter.
+        :param segmenter: the segmenter
+        :param max_batch_size: maximum number of images per batch, by default settings.SEGMENT_BATCH_SIZE
+        :param prefetch_batches: number of batches decoded and normalized in background threads while the
+        segmenter runs, by default settings.PREFETCH_BATCHES
+        :param with_uncertain: count the uncertain pixels, by default settings.COMPUTE_UNCERTAIN_PIXELS
+        """
+
+        self.segmenter = segmenter
+        self.with_uncertain = settings.COMPUTE_UNCERTAIN_PIXELS if with_uncertain is None else with_uncertain
+        self.max_batch_size = max_batch_size or settings.SEGMENT_BATCH_SIZE
+        self.prefetch_batches = max(1, prefetch_batches or settings.PREFETCH_BATCHES)
+        self.pending = []
+        self.owners = []
+
+    def submit(self, owner, images):
+        """
+        Queue the images of an owner.
+        :param owner: the owner of the images, e.g. the patient id
+        :param images: list with the file name and the image, the path of a grayscale PNG or a loader returning
+        the image
+        :return: nothing
+        """
+
+        self.owners.append(owner)
+
+        for file_name, image in images:
+            self.pending.append((owner, file_name, image))
+
+    def run(self, owner_done=None):
+        """
+        Segment all the queued images, the batches can mix images of different owners. The next batches are
+        read and prepared in background threads while the current batch is segmented.
+        :param owner_done: optional callback called with the owner and its predictions, a list with the file
+        name, the uint8 mask, the left ventricle pixel count and the uncertain pixel count, as soon as all the
+        images of the owner are segmented. The masks of an owner are released after the callback.
+        :return: dictionary owner -> list with the file name, the left ventricle pixel count and the uncertain
+        pixel count, zero unless with_uncertain is set
+        """
+
+        results = dict((owner, []) for owner in self.owners)
+        remaining = collections.Counter(owner for owner, _, _ in self.pending)
+        batches = [self.pending[i:i + self.max_batch_size] for i in range(0, len(self.pending), self.max_batch_size)]
+
+        if owner_done is not None:
+            for owner in self.owners:
+                if remaining[owner] == 0:
+                    owner_done(owner, results[owner])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.prefetch_batches) as executor:
+            prepared = collections.deque(executor.submit(prepare_batch, batch) for batch in
+                                         batches[:self.prefetch_batches])
+            next_batch = len(prepared)
+
+            while len(prepared) > 0:
+                items, images = prepared.popleft().result()
+
+                if next_batch < len(batches):
+                    prepared.append(executor.submit(prepare_batch, batches[next_batch]))
+                    next_batch += 1
+
+                predictions, pixel_counts, uncertain_counts = self.segmenter.predict_with_counts(
+                    images, with_uncertain=self.with_uncertain)
+
+                for (owner, file_name, _), prediction, pixel_count, uncertain_count in zip(
+                        items, predictions, pixel_counts, uncertain_counts):
+                    # a copy so the batch predictions are not kept alive by the views
+                    results[owner].append((file_name, prediction.astype(np.uint8), int(pixel_count),
+                                           int(uncertain_count)))
+                    remaining[owner] -= 1
+
+                    if remaining[owner] == 0:
+                        if owner_done is not None:
+                            owner_done(owner, results[owner])
+
+                        results[owner] = [(file_name, pixel_count, uncertain_count) for
+                                          file_name, _, pixel_count, uncertain_count in results[owner]]
+
+        self.pending = []
+        self.owners = []
+
+        return results
+
+
+def write_overlays(patient_id, predictions, save_transparents=False):
+    """
+    Write the predicted overlays of a patient.
     :param patient_id: patient id
+    :param predictions: list with the file name, the prediction and the pixel counts
     :param save_transparents: boolean value
     :return: nothing
     """
 
-    segmenter = LVSegmentation()
-
-    src_image_dir = utils.get_pred_patient_img_dir(patient_id)
     overlay_dir = utils.get_pred_patient_overlay_dir(patient_id)
-    utils.delete_files(overlay_dir, "*.png")
     transparent_overlay_dir = utils.get_pred_patient_transparent_overlay_dir(patient_id)
-    utils.delete_files(transparent_overlay_dir, "*.png")
 
-    num_lines = sum(1 for l in open(src_image_dir + "pred.lst"))
-    batch_size = 1
+    for file_name, prediction, _, _ in predictions:
+        image = numpy.zeros(prediction.shape, dtype=numpy.float32)
+        image[prediction == 1] = 255
 
-    for try_size in [2, 3, 4, 5]:
-        if num_lines % try_size == 0:
-            batch_size = try_size
+        cv2.imwrite(overlay_dir + file_name, image)
 
-    prefix = str(patient_id).rjust(4, '0')
-    src_files = utils.get_files(src_image_dir, prefix + "*.png")
+        if save_transparents:
+            channels = cv2.split(image)
+            empty = numpy.zeros(channels[0].shape, dtype=numpy.float32)
+            alpha = channels[0].copy()
+            alpha[alpha == 255] = 75
+            channels = (channels[0], channels[0], empty, alpha)
 
-    for i in range(0, num_lines, batch_size):
-        src_files_batch = src_files[i:i + batch_size]
-        images = []
+            transparent_overlay = cv2.merge(channels)
+            cv2.imwrite(transparent_overlay_dir + file_name, transparent_overlay)
 
-        for src_file in src_files_batch:
-            image = cv2.imread(src_file, cv2.IMREAD_GRAYSCALE)
-            images.append(image)
 
-        images = np.array(images)
-        images = np.float32(images)
+def predict_overlays_patients(patient_images, save_transparents=False, segmenter=None, max_batch_size=None):
+    """
+    Predict the left ventricle for several patients, the images of all patients share the segmenter batches.
+    The overlays of a patient are written in background threads as soon as all its images are segmented, with
+    SAVE_OVERLAYS disabled no overlay is written.
+    :param patient_images: dictionary patient id -> list with the file name and the image loader returned by
+    prepare_patient_images, for None the images are read from the patient image directory or from the image store
+    :param save_transparents: boolean value
+    :param segmenter: shared segmenter, by default a segmenter is created and closed for this call
+    :param max_batch_size: maximum number of images per batch, by default settings.SEGMENT_BATCH_SIZE
+    :return: dictionary patient id -> dictionary file name -> left ventricle pixel count and uncertain pixel count
+    """
 
-        original_images = images
+    own_segmenter = segmenter is None
+    if own_segmenter:
+        segmenter = create_segmenter()
 
-        images -= np.mean(images, dtype=np.float32)
-        images /= np.std(images, dtype=np.float32)
+    scheduler = SegmentationScheduler(segmenter, max_batch_size=max_batch_size)
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=settings.OVERLAY_WRITER_THREADS)
+    writes = []
+    pixel_counts = {}
 
-        images = np.reshape(images, (-1, 224, 224, 1))
+    def write_patient_overlays(patient_id, predictions):
+        pixel_counts[patient_id] = dict((file_name, (pixel_count, uncertain_count)) for
+                                        file_name, _, pixel_count, uncertain_count in predictions)
 
-        predictions = segmenter.predict(images)
+        if SAVE_OVERLAYS:
+            writes.append(writer.submit(write_overlays, patient_id, predictions, save_transparents))
 
-        for j in range(len(predictions)):
-            file_name = ntpath.basename(src_files_batch[j])
-            image = original_images[j]
-            prediction = predictions[j]
+    for patient_id, images in patient_images.items():
+        utils.delete_files(utils.get_pred_patient_overlay_dir(patient_id), "*.png")
+        utils.delete_files(utils.get_pred_patient_transparent_overlay_dir(patient_id), "*.png")
 
-            image[prediction == 1] = 255
-            image[prediction == 0] = 0
+        if images is None:
+            if settings.USE_IMAGE_STORE:
+                images = prepare_patient_images(patient_id)
+            else:
+                images = [(ntpath.basename(src_file), src_file) for src_file in utils.get_patient_images(patient_id)]
 
-            cv2.imwrite(overlay_dir + file_name, image)
+        scheduler.submit(patient_id, images)
 
-            if save_transparents:
-                channels = cv2.split(image)
-                empty = numpy.zeros(channels[0].shape, dtype=numpy.float32)
-                alpha = channels[0].copy()
-                alpha[alpha == 255] = 75
-                channels = (channels[0], channels[0], empty, alpha)
+    try:
+        scheduler.run(owner_done=write_patient_overlays)
+    finally:
+        writer.shutdown(wait=True)
 
-                transparent_overlay = cv2.merge(channels)
-                cv2.imwrite(transparent_overlay_dir + file_name, transparent_overlay)
+        if own_segmenter:
+            segmenter.close()
 
-    segmenter.session.close()
+    for write in writes:
+        write.result()
+
+    return pixel_counts
+
+
+def predict_overlays_patient(patient_id, save_transparents=False, images=None, segmenter=None):
+    """
+    Predict the left ventricle with neural network.
+    :param patient_id: patient id
+    :param save_transparents: boolean value
+    :param images: list with the file name and the image loader returned by prepare_patient_images, by default the
+    images are read from the patient image directory
+    :param segmenter: shared segmenter, by default a segmenter is created and closed for this patient
+    :return: dictionary file name -> left ventricle pixel count and uncertain pixel count
+    """
+
+    return predict_overlays_patients({patient_id: images}, save_transparents=save_transparents,
+                                     segmenter=segmenter)[patient_id]
 
 
 def get_filename(file_path):
@@ -277,12 +488,35 @@ def interpolate_series(pixel_series):
     return pixel_series
 
 
-def count_pixels(patient_id, all_slice_data, model_name):
+def read_overlay_pixel_counts(patient_id):
+    """
+    Count the left ventricle pixels and the low confidence pixels of the overlays written for a patient.
+    :param patient_id: patient id
+    :return: dictionary file name -> pixel count and low confidence pixel count
+    """
+
+    pixel_counts = {}
+
+    for overlay_path in utils.get_patient_overlays(patient_id):
+        overlay_img = cv2.imread(overlay_path, cv2.IMREAD_GRAYSCALE)
+
+        low_confidence_pixel_count = ((overlay_img < LOW_CONFIDENCE_PIXEL_THRESHOLD) & (overlay_img > 20)).sum()
+
+        pixel_count = overlay_img.sum() / 255
+
+        pixel_counts[ntpath.basename(overlay_path)] = (pixel_count, low_confidence_pixel_count)
+
+    return pixel_counts
+
+
+def count_pixels(patient_id, all_slice_data, model_name, pixel_counts=None):
     """
     Count the pixels from the left ventricle.
     :param patient_id: patient id
     :param all_slice_data: all slice date from CVS file.
     :param model_name: neural network name.
+    :param pixel_counts: dictionary file name -> pixel count and uncertain pixel count returned by the segmentation,
+    by default the counts are read from the overlays
     :return: data frame
     """
 
@@ -315,16 +549,11 @@ def count_pixels(patient_id, all_slice_data, model_name):
         frame_pixel_series[str(frame_no).rjust(2, '0')] = [-1] * len(slices)
         frame_confidence_series[str(frame_no).rjust(2, '0')] = [-1] * len(slices)
 
-    overlay_paths = utils.get_patient_overlays(patient_id)
+    if pixel_counts is None:
+        pixel_counts = read_overlay_pixel_counts(patient_id)
 
-    for overlay_path in overlay_paths:
-        overlay_img = cv2.imread(overlay_path, cv2.IMREAD_GRAYSCALE)
-
-        low_confidence_pixel_count = ((overlay_img < LOW_CONFIDENCE_PIXEL_THRESHOLD) & (overlay_img > 20)).sum()
-
-        pixel_count = overlay_img.sum() / 255
-
-        file_name = get_filename(overlay_path)
+    for overlay_name, (pixel_count, low_confidence_pixel_count) in sorted(pixel_counts.items()):
+        file_name = get_filename(overlay_name)
 
         if file_name not in file_name_slices:
             continue
@@ -359,10 +588,18 @@ def count_pixels(patient_id, all_slice_data, model_name):
     data_frame["slice_dist"] = (
         patient_slice_data_frame1["slice_location"].shift(-1) - patient_slice_data_frame1["slice_location"]).values
     data_frame["slice_dist"].fillna(data_frame["slice_dist"].mean(), inplace=True)
-    data_frame["slice_location2a"] = patient_slice_data_frame1["slice_location2"].values
-    data_frame["slice_location2b"] = patient_slice_data_frame1["slice_location2"].shift(-1).values
-    data_frame["slice_dist2"] = data_frame.apply(
-        lambda row: compute_distance(row["slice_location2a"], row["slice_location2b"]), axis=1)
+
+    if "location_x" in patient_slice_data_frame1.columns:
+        locations = patient_slice_data_frame1[["location_x", "location_y", "location_z"]].values
+        slice_dist2 = numpy.full(len(locations), numpy.nan)
+        slice_dist2[:-1] = numpy.sqrt(((locations[:-1] - locations[1:]) ** 2).sum(axis=1))
+        data_frame["slice_dist2"] = slice_dist2
+    else:
+        data_frame["slice_location2a"] = patient_slice_data_frame1["slice_location2"].values
+        data_frame["slice_location2b"] = patient_slice_data_frame1["slice_location2"].shift(-1).values
+        data_frame["slice_dist2"] = data_frame.apply(
+            lambda row: compute_distance(row["slice_location2a"], row["slice_location2b"]), axis=1)
+
     data_frame["slice_dist2"].fillna(data_frame["slice_dist2"].mean(), inplace=True)
 
     deltas = abs(abs(data_frame["slice_dist"]) - abs(data_frame["slice_dist2"])).sum()
@@ -585,83 +822,141 @@ def evaluate_volume(patient_id, diastole_vol, systole_vol, pred_model_name, scal
     return err_dia, err_sys
 
 
-def predict_patient(patient_id, all_slice_data, pred_model_name, debug_info=False):
+def segment_patients(patient_ids, intermediate_crop=0, segmenter=None):
     """
-    The main method.
+    List the images of the patients and segment them together, the images are read and cropped while the
+    previous batches are segmented.
+    :param patient_ids: patient ids
+    :param intermediate_crop: optional parameter
+    :param segmenter: shared LVSegmentation
+    :return: dictionary patient id -> dictionary file name -> pixel counts, None when SEGMENT_IMAGES is disabled
+    """
+
+    pixel_counts = None
+    patient_images = {}
+
+    for patient_id in patient_ids:
+        patient_images[patient_id] = None
+
+        if PROCESS_IMAGES:
+            # without the segmentation nothing would call the loaders, the cropped images are written now
+            patient_images[patient_id] = prepare_patient_images(patient_id, intermediate_crop=intermediate_crop,
+                                                                lazy=SEGMENT_IMAGES)
+
+    print("Inceput - Pas 2 - Segmentare")
+    print("   > Segmentarea imaginilor")
+
+    if SEGMENT_IMAGES:
+        pixel_counts = predict_overlays_patients(patient_images, save_transparents=True, segmenter=segmenter)
+
+    print("Terminat - Pas 2 - Segmentare")
+
+    return pixel_counts
+
+
+def estimate_patient_volumes(patient_id, all_slice_data, pred_model_name, intermediate_crop=0, debug_info=False,
+                             pixel_counts=None):
+    """
+    Count the pixels of the segmented images, compute and evaluate the volumes of a patient.
     :param patient_id: patient id
     :param all_slice_data: all slices data
     :param pred_model_name: neural network model name
+    :param intermediate_crop: the crop used for the images
     :param debug_info: optional parameter for debug information
-    :return: nothing
+    :param pixel_counts: pixel counts returned by the segmentation, by default they are read from the overlays
+    :return: diastole volume
     """
 
-    if not os.path.exists(settings.RESULT_DIR + PREDICTION_FILENAME):
-        shutil.copyfile(settings.RESULT_DIR + "train_enriched.csv", settings.RESULT_DIR + PREDICTION_FILENAME)
-
     global current_debug_line
     current_debug_line = [str(patient_id)]
 
-    done = False
-    intermediate_crop = 0
-    round_no = 0
+    print("Inceput - Pas 3 - Prezicerea volumului")
 
-    while not done:
-        if PROCESS_IMAGES:
-            prepare_patient_images(patient_id, intermediate_crop=intermediate_crop)
+    print("   > Numararea pixelilor")
 
-        print("Inceput - Pas 2 - Segmentare")
-        print("   > Segmentarea imaginilor")
+    if COUNT_PIXELS:
+        pixel_frame = count_pixels(patient_id, all_slice_data, pred_model_name, pixel_counts=pixel_counts)
 
-        if SEGMENT_IMAGES:
-            predict_overlays_patient(patient_id, save_transparents=True)
+    print("   > Calcularea volumului")
 
-        print("Terminat - Pas 2 - Segmentare")
+    if COMPUTE_VOLUMES:
+        diastole_vol, systole_vol, diastole_lowconf_vol, systole_lowconf_vol, diastole_frame, systole_frame, diastole_max, systole_max = compute_volumes(
+            patient_id, pred_model_name, debug_info=debug_info)
 
-        print("Inceput - Pas 3 - Prezicerea volumului")
+        scale = 1
+        if intermediate_crop != 0:
+            scale = float(intermediate_crop) / float(settings.TARGET_CROP)
+            scale *= scale
+            diastole_vol *= scale
+            systole_vol *= scale
 
-        print("   > Numararea pixelilor")
+    print("Terminat - Pas 3 - Prezicerea volumului")
 
-        if COUNT_PIXELS:
-            pixel_frame = count_pixels(patient_id, all_slice_data, pred_model_name)
+    if debug_info:
+        current_debug_line.append(str(round(diastole_vol, 2)))
+        current_debug_line.append(str(round(systole_vol, 2)))
 
-        print("   > Calcularea volumului")
+    err_dia, err_sys = evaluate_volume(patient_id, diastole_vol, systole_vol, pred_model_name, scale,
+                                       diastole_lowconf_vol, systole_lowconf_vol, diastole_frame, systole_frame,
+                                       diastole_max, systole_max, debug_info=debug_info)
 
-        if COMPUTE_VOLUMES:
-            diastole_vol, systole_vol, diastole_lowconf_vol, systole_lowconf_vol, diastole_frame, systole_frame, diastole_max, systole_max = compute_volumes(
-                patient_id, pred_model_name, debug_info=debug_info)
+    global_dia_errors.append(abs(err_dia))
+    global_sys_errors.append(abs(err_sys))
 
-            scale = 1
-            if intermediate_crop != 0:
-                scale = float(intermediate_crop) / float(settings.TARGET_CROP)
-                scale *= scale
-                diastole_vol *= scale
-                systole_vol *= scale
+    return diastole_vol
 
-        print("Terminat - Pas 3 - Prezicerea volumului")
 
-        if debug_info:
-            current_debug_line.append(str(round(diastole_vol, 2)))
-            current_debug_line.append(str(round(systole_vol, 2)))
+def predict_patients(patient_ids, all_slice_data, pred_model_name, debug_info=False, segmenter=None):
+    """
+    Predict the volumes of several patients, the images of all the patients are segmented in shared batches.
+    The patients with a diastole volume over 340 are segmented again with an intermediate crop.
+    :param patient_ids: patient ids
+    :param all_slice_data: all slices data
+    :param pred_model_name: neural network model name
+    :param debug_info: optional parameter for debug information
+    :param segmenter: shared LVSegmentation used for all the patients of a batch run
+    :return: nothing
+    """
 
-        err_dia, err_sys = evaluate_volume(patient_id, diastole_vol, systole_vol, pred_model_name, scale,
-                                           diastole_lowconf_vol, systole_lowconf_vol, diastole_frame, systole_frame,
-                                           diastole_max, systole_max, debug_info=debug_info)
+    if not os.path.exists(settings.RESULT_DIR + PREDICTION_FILENAME):
+        shutil.copyfile(settings.RESULT_DIR + "train_enriched.csv", settings.RESULT_DIR + PREDICTION_FILENAME)
 
-        if diastole_vol > 340 and round_no == 0 and SEGMENT_IMAGES:
-            intermediate_crop = 220
-            current_debug_line = [str(patient_id)]
-            round_no = 1
-        else:
-            done = True
+    pixel_counts = segment_patients(patient_ids, segmenter=segmenter) or {}
+    retry_patient_ids = []
+
+    for patient_id in patient_ids:
+        diastole_vol = estimate_patient_volumes(patient_id, all_slice_data, pred_model_name, debug_info=debug_info,
+                                                pixel_counts=pixel_counts.get(patient_id))
 
-        global_dia_errors.append(abs(err_dia))
-        global_sys_errors.append(abs(err_sys))
+        if diastole_vol > 340 and SEGMENT_IMAGES:
+            retry_patient_ids.append(patient_id)
+
+    if len(retry_patient_ids) > 0:
+        pixel_counts = segment_patients(retry_patient_ids, intermediate_crop=220, segmenter=segmenter)
+
+        for patient_id in retry_patient_ids:
+            estimate_patient_volumes(patient_id, all_slice_data, pred_model_name, intermediate_crop=220,
+                                     debug_info=debug_info, pixel_counts=pixel_counts[patient_id])
+
+
+def predict_patient(patient_id, all_slice_data, pred_model_name, debug_info=False, segmenter=None):
+    """
+    The main method.
+    :param patient_id: patient id
+    :param all_slice_data: all slices data
+    :param pred_model_name: neural network model name
+    :param debug_info: optional parameter for debug information
+    :param segmenter: shared LVSegmentation used for all the patients of a batch run
+    :return: nothing
+    """
+
+    predict_patients([patient_id], all_slice_data, pred_model_name, debug_info=debug_info, segmenter=segmenter)
 
     return None
 
 
 if __name__ == "__main__":
-    slice_data = pandas.read_csv(settings.RESULT_DIR + "dicom_data_enriched.csv", sep=";")
+    slice_data = utils.load_metadata("dicom_data_enriched")
     current_debug_line = ["patient", "dia_col", "sys_col", "dia_vol", "sys_vol", "dia_err", "sys_err"]
 
     model_name = MODEL_NAME + "_folder"
@@ -672,14 +967,21 @@ if __name__ == "__main__":
 
     print("Predicting model " + model_name)
 
-    for i in range(range_start, range_end):
+    segmenter = create_segmenter()
+
+    try:
+        for i in range(range_start, range_end, PATIENT_BATCH_SIZE):
 
-        predict_patient(i, slice_data, model_name, debug_info=True)
+            predict_patients(list(range(i, min(i + PATIENT_BATCH_SIZE, range_end))), slice_data, model_name,
+                             debug_info=True, segmenter=segmenter)
 
-        if len(global_dia_errors) % 20 == 0:
-            current_debug_line = ["avg", "", "", "", "", round(sum(global_dia_errors) / len(global_dia_errors), 2),
-                                  round(sum(global_sys_errors) / len(global_sys_errors), 2)]
-            print("\t".join(map(lambda x: str(x).rjust(10), current_debug_line)))
+            if len(global_dia_errors) > 0:
+                current_debug_line = ["avg", "", "", "", "",
+                                      round(sum(global_dia_errors) / len(global_dia_errors), 2),
+                                      round(sum(global_sys_errors) / len(global_sys_errors), 2)]
+                print("\t".join(map(lambda x: str(x).rjust(10), current_debug_line)))
+    finally:
+        segmenter.close()
 
     global_dia_errors = []
     global_sys_errors = []
@@ -0,0 +1,161 @@
+import queue
+import threading
+
+import cv2
+import numpy
+
+import utils.settings as settings
+import utils.utils as utils
+
+
+def random_elastic_maps(shape, alpha, sigma, random_state):
+    """
+    Random smooth displacement field for an elastic deformation, as pixel maps for cv2.remap.
+    :param shape: image shape
+    :param alpha: scale of the displacement
+    :param sigma: smoothing of the displacement
+    :param random_state: numpy random state
+    :return: x map and y map
+    """
+
+    height, width = shape
+    dx = cv2.GaussianBlur((random_state.rand(height, width) * 2 - 1).astype(numpy.float32), (0, 0), sigma) * alpha
+    dy = cv2.GaussianBlur((random_state.rand(height, width) * 2 - 1).astype(numpy.float32), (0, 0), sigma) * alpha
+    x, y = numpy.meshgrid(numpy.arange(width, dtype=numpy.float32), numpy.arange(height, dtype=numpy.float32))
+
+    return x + dx, y + dy
+
+
+def augment_sample(image, label, random_state, crop_size=224):
+    """
+    Apply the same random rotation, elastic deformation and crop to an image and its label. The image is
+    interpolated linearly, the label with the nearest neighbour so that it stays a mask.
+    :param image: uint8 image
+    :param label: uint8 label
+    :param random_state: numpy random state
+    :param crop_size: size of the random crop
+    :return: augmented image and label
+    """
+
+    height, width = image.shape
+    angle = random_state.uniform(-settings.AUGMENT_MAX_ROTATION, settings.AUGMENT_MAX_ROTATION)
+
+    if angle != 0:
+        rot_mat = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1)
+        image = cv2.warpAffine(image, rot_mat, (width, height), flags=cv2.INTER_LINEAR)
+        label = cv2.warpAffine(label, rot_mat, (width, height), flags=cv2.INTER_NEAREST)
+
+    if random_state.rand() < settings.AUGMENT_ELASTIC_PROBABILITY:
+        map_x, map_y = random_elastic_maps(image.shape, settings.AUGMENT_ELASTIC_ALPHA, settings.AUGMENT_ELASTIC_SIGMA,
+                                           random_state)
+        image = cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        label = cv2.remap(label, map_x, map_y, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    crop_x = random_state.randint(0, width - crop_size + 1)
+    crop_y = random_state.randint(0, height - crop_size + 1)
+
+    return (image[crop_y:crop_y + crop_size, crop_x:crop_x + crop_size],
+            label[crop_y:crop_y + crop_size, crop_x:crop_x + crop_size])
+
+
+class AugmentationPipeline(object):
+    def __init__(self, images, labels, batch_size, epochs, workers=None, queue_size=None, seed=1301):
+        """
+        Augment the training batches in background threads. The batches are returned in the training order, each
+        batch is augmented with its own random state so the result doesn't depend on the number of workers.
+        :param images: uint8 images
+        :param labels: uint8 labels
+        :param batch_size: batch size
+        :param epochs: number of epochs
+        :param workers: number of threads, by default settings.AUGMENT_WORKERS
+        :param queue_size: maximum number of prepared batches, by default settings.AUGMENT_QUEUE_SIZE
+        :param seed: seed of the random states
+        """
+
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.seed = seed
+        self.workers = max(1, workers or settings.AUGMENT_WORKERS)
+        self.steps = list(range(0, len(images), batch_size)) * epochs
+        self.next_job = 0
+
+        queue_size = queue_size or settings.AUGMENT_QUEUE_SIZE
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // self.workers)) for _ in range(self.workers)]
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.work, args=(worker_no,)) for worker_no in range(self.workers)]
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def make_batch(self, job_no):
+        """
+        Augment and normalize one batch.
+        :param job_no: number of the batch in the training order
+        :return: images with the shape (-1, 224, 224, 1) and labels
+        """
+
+        random_state = numpy.random.RandomState(self.seed + job_no)
+        step = self.steps[job_no]
+        images, labels = [], []
+
+        for image, label in zip(self.images[step:step + self.batch_size], self.labels[step:step + self.batch_size]):
+            image, label = augment_sample(image, label, random_state)
+            images.append(image)
+            labels.append(label)
+
+        images = utils.normalize_batch(numpy.array(images))
+
+        return numpy.reshape(images, (-1, 224, 224, 1)), numpy.array(labels)
+
+    def work(self, worker_no):
+        """
+        Worker thread, prepares every workers-th batch.
+        :param worker_no: worker number
+        :return: nothing
+        """
+
+        for job_no in range(worker_no, len(self.steps), self.workers):
+            try:
+                item = self.make_batch(job_no)
+            except Exception as e:
+                item = e
+
+            while not self.stopped.is_set():
+                try:
+                    self.queues[worker_no].put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+            if self.stopped.is_set() or isinstance(item, Exception):
+                return
+
+    def next_batch(self):
+        """
+        Get the next batch in the training order, waits for the worker if the batch isn't ready.
+        :return: images and labels
+        """
+
+        if self.next_job >= len(self.steps):
+            raise StopIteration()
+
+        item = self.queues[self.next_job % self.workers].get()
+        self.next_job += 1
+
+        if isinstance(item, Exception):
+            raise item
+
+        return item
+
+    def close(self):
+        """
+        Stop the workers
+        :return: nothing
+        """
+
+        self.stopped.set()
+
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,133 @@
+import json
+import sqlite3
+
+import utils.settings as settings
+
+
+class DicomIndex(object):
+    def __init__(self, index_path=None):
+        """
+        On-disk index with the CSV fields of every ingested DICOM file, keyed by path, size and mtime.
+        :param index_path: path to the SQLite file, by default RESULT_DIR/dicom_index.sqlite
+        """
+
+        if index_path is None:
+            index_path = settings.BASE_DIR + settings.RESULT_DIR + "dicom_index.sqlite"
+
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, patient_dir TEXT, "
+                                "patient_id TEXT, size INTEGER, mtime INTEGER, img_path TEXT, row TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS changed_patients (patient_id TEXT PRIMARY KEY)")
+        self.connection.commit()
+
+    def close(self):
+        """
+        Close the index
+        :return: nothing
+        """
+
+        self.connection.close()
+
+    def clear(self):
+        """
+        Remove all the files from the index
+        :return: nothing
+        """
+
+        self.connection.execute("DELETE FROM files")
+        self.connection.commit()
+
+    def get_changes(self, file_stats):
+        """
+        Compare the files on disk with the index.
+        :param file_stats: dictionary path -> (size, mtime) with the files found on disk
+        :return: list with the new or changed paths and list with the deleted paths
+        """
+
+        indexed = {}
+        for path, size, mtime in self.connection.execute("SELECT path, size, mtime FROM files"):
+            indexed[path] = (size, mtime)
+
+        changed = [path for path, stat in file_stats.items() if indexed.get(path) != tuple(stat)]
+        deleted = [path for path in indexed if path not in file_stats]
+
+        return sorted(changed), sorted(deleted)
+
+    def put(self, path, patient_dir, size, mtime, img_path, row):
+        """
+        Add or replace a file in the index.
+        :param path: path of the DICOM file
+        :param patient_dir: patient directory
+        :param size: file size
+        :param mtime: file modification time in nanoseconds
+        :param img_path: path of the preprocessed image
+        :param row: the CSV row of the file
+        :return: nothing
+        """
+
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (path, patient_dir, row[0], size, mtime, img_path, json.dumps(row)))
+
+    def get_file(self, path):
+        """
+        Get the patient id, the preprocessed image and the patient directory of an indexed file.
+        :param path: path of the DICOM file
+        :return: patient id, image path and patient directory or None if the file is not indexed
+        """
+
+        return self.connection.execute("SELECT patient_id, img_path, patient_dir FROM files WHERE path = ?",
+                                       (path,)).fetchone()
+
+    def remove(self, paths):
+        """
+        Remove files from the index.
+        :param paths: paths of the DICOM files
+        :return: nothing
+        """
+
+        self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+
+    def commit(self):
+        """
+        Save the pending changes
+        :return: nothing
+        """
+
+        self.connection.commit()
+
+    def get_rows(self, sort_key):
+        """
+        Get the CSV rows of all indexed files.
+        :param sort_key: sort key for the patient directories
+        :return: list with the CSV rows ordered by patient directory and path
+        """
+
+        records = self.connection.execute("SELECT patient_dir, path, row FROM files").fetchall()
+        records.sort(key=lambda record: (sort_key(record[0]), record[1]))
+
+        return [json.loads(record[2]) for record in records]
+
+    def set_changed_patients(self, patient_ids):
+        """
+        Save the patients changed by the last ingest.
+        :param patient_ids: patient ids
+        :return: nothing
+        """
+
+        self.connection.execute("DELETE FROM changed_patients")
+        self.connection.executemany("INSERT INTO changed_patients VALUES (?)",
+                                    [(str(patient_id),) for patient_id in patient_ids])
+        self.connection.commit()
+
+    def get_changed_patients(self):
+        """
+        Get the patients changed by the last ingest.
+        :return: set with the patient ids, numeric ids are returned as int
+        """
+
+        res = set()
+        for patient_id, in self.connection.execute("SELECT patient_id FROM changed_patients"):
+            res.add(int(patient_id) if patient_id.isdigit() else patient_id)
+
+        return res
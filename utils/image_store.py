@@ -0,0 +1,114 @@
+import json
+import ntpath
+import os
+
+import numpy
+
+import utils.settings as settings
+
+
+def get_patient_store_paths(patient_id):
+    """
+    Return the paths of the patient image tensor and of its index.
+    :param patient_id: patient id
+    :return: tensor path, index path
+    """
+
+    prefix = settings.IMAGE_STORE_DIR + str(patient_id).rjust(4, '0')
+
+    return prefix + ".npy", prefix + ".json"
+
+
+def write_patient_images(patient_id, images):
+    """
+    Write all the preprocessed images of a patient as one contiguous uint8 array (frames x slices x H x W)
+    and a small json index. The frames are ordered by instance number, the slices by series and slice location.
+    :param patient_id: patient id
+    :param images: list with (image path, uint8 image, instance number, series description, slice location) from
+    the DICOM record of every image
+    :return: nothing
+    """
+
+    if not os.path.exists(settings.IMAGE_STORE_DIR):
+        os.makedirs(settings.IMAGE_STORE_DIR)
+
+    frames = []
+    slices = []
+    cells = {}
+    files = []
+
+    for img_path, img, instance_number, series, slice_location in sorted(images, key=lambda x: ntpath.basename(x[0])):
+        file_name = ntpath.basename(img_path)
+        frame_key = int(instance_number)
+        slice_key = [str(series), float(slice_location), 1]
+
+        while (frame_key, tuple(slice_key)) in cells:
+            slice_key[2] += 1
+
+        slice_key = tuple(slice_key)
+
+        if frame_key not in frames:
+            frames.append(frame_key)
+        if slice_key not in slices:
+            slices.append(slice_key)
+
+        cells[(frame_key, slice_key)] = img
+        files.append([file_name, frame_key, slice_key])
+
+    frames.sort()
+    slices.sort()
+    height, width = images[0][1].shape
+    tensor = numpy.zeros((len(frames), len(slices), height, width), dtype=numpy.uint8)
+
+    for file_info in files:
+        frame_index = frames.index(file_info[1])
+        slice_index = slices.index(file_info[2])
+        tensor[frame_index, slice_index] = cells[(file_info[1], file_info[2])]
+        file_info[1] = frame_index
+        file_info[2] = slice_index
+
+    tensor_path, index_path = get_patient_store_paths(patient_id)
+    numpy.save(tensor_path, tensor)
+
+    with open(index_path, "w") as f:
+        json.dump({"frames": frames, "slices": slices, "files": files}, f)
+
+
+def delete_patient_images(patient_id):
+    """
+    Delete the image tensor of a patient.
+    :param patient_id: patient id
+    :return: nothing
+    """
+
+    for path in get_patient_store_paths(patient_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_patient_images(patient_id):
+    """
+    Memory-map the image tensor of a patient.
+    :param patient_id: patient id
+    :return: read-only array (frames x slices x H x W) and the index
+    """
+
+    tensor_path, index_path = get_patient_store_paths(patient_id)
+
+    with open(index_path) as f:
+        index = json.load(f)
+
+    return numpy.load(tensor_path, mmap_mode="r"), index
+
+
+def enumerate_patient_images(patient_id):
+    """
+    Enumerate the images of a patient without copying them.
+    :param patient_id: patient id
+    :return: return enumerate file name and image view
+    """
+
+    tensor, index = load_patient_images(patient_id)
+
+    for file_name, frame_index, slice_index in index["files"]:
+        yield file_name, tensor[frame_index, slice_index]
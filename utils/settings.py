@@ -4,13 +4,39 @@ DATA_DIR = BASE_DIR + "data/"
 BASE_PREPROCESSEDIMAGES_DIR = RESULT_DIR + "preprocessed_images/"
 BASE_TRAIN_SEGMENT_DIR = RESULT_DIR + "segmenter_trainset/"
 PATIENT_PRED_DIR = RESULT_DIR + "patient_predictions/"
+IMAGE_STORE_DIR = RESULT_DIR + "image_store/"
 
 MODEL_NAME = "vgg"
+UNPOOL_METHOD = "flat"
+SEGMENTER_TRAIN_CACHE = None
+TRAIN_LOG_STEPS = 0
+AUGMENT_TRAINING = False
+TRAIN_WORKERS = 4
+AUGMENT_WORKERS = 2
+AUGMENT_QUEUE_SIZE = 8
+AUGMENT_MAX_ROTATION = 15.
+AUGMENT_ELASTIC_PROBABILITY = 0.5
+AUGMENT_ELASTIC_ALPHA = 100.
+AUGMENT_ELASTIC_SIGMA = 10.
+SEGMENTER_BASE_DIR = DATA_DIR + "segmenter/"
+SEGMENTER_DIR = SEGMENTER_BASE_DIR if MODEL_NAME == "vgg" else SEGMENTER_BASE_DIR + MODEL_NAME + "/"
+SEGMENTER_GRAPH_PATH = SEGMENTER_DIR + "inference_graph.pb"
+SEGMENTER_QUANTIZED_GRAPH_PATH = SEGMENTER_DIR + "inference_graph_int8.pb"
+USE_QUANTIZED_SEGMENTER = False
+QUANTIZATION_CALIBRATION_IMAGES = 100
 TRAIN_EPOCHS = 40
 FOLD_COUNT = 6
+PREPROCESS_WORKERS = 1
+USE_IMAGE_STORE = False
+METADATA_FORMAT = "csv"
 
 TARGET_SIZE = 256
 TARGET_CROP = 224
 CROP_INDENT_X = 16
 CROP_INDENT_Y = 16
 CROP_SIZE = 16
+SEGMENT_BATCH_SIZE = 32
+PREFETCH_BATCHES = 2
+UNCERTAIN_PROBABILITY_RANGE = (20. / 255., 200. / 255.)
+COMPUTE_UNCERTAIN_PIXELS = False
+OVERLAY_WRITER_THREADS = 2
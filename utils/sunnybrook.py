@@ -2,20 +2,26 @@ import dicom
 import cv2
 import re
 import os
+import sys
+import json
+import hashlib
 import fnmatch
 import numpy as np
 import matplotlib.pyplot as plt
 import warnings
-import scipy
-import scipy.misc
 import random
 
+from utils.utils_dicom import bytescale
+
 warnings.filterwarnings('ignore')
 random.seed(1301)
 
 SUNNYBROOK_ROOT_PATH = "../../data/"
 CONTOUR_PATH = os.path.join(SUNNYBROOK_ROOT_PATH, "Sunnybrook Contours")
 IMG_PATH = os.path.join(SUNNYBROOK_ROOT_PATH, "Sunnybrook IMG")
+ARCHIVE_PATH = os.path.join(SUNNYBROOK_ROOT_PATH, "sunnybrook_contours.npz")
+
+loaded_archive = None
 
 SAX_SERIES = {
     'SC-HF-I-1': '0004',
@@ -128,9 +134,127 @@ def __get_all_contours(contour_path):
     return extracted
 
 
+def get_image_path(contour, img_path=None):
+    """
+    Get the PNG image of a contour.
+    :param contour: the contour
+    :param img_path: path to image folder, by default IMG_PATH
+    :return: path of the image
+    """
+
+    if img_path is None:
+        img_path = IMG_PATH
+
+    return os.path.join(img_path, contour.case, "IM-%s-%04d.png" % (SAX_SERIES[contour.case], contour.img_no))
+
+
+def get_manifest_hash(contours):
+    """
+    Hash the paths, sizes and modification times of the contour files and of their images.
+    :param contours: the contours
+    :return: hex digest
+    """
+
+    manifest = []
+
+    for ctr in contours:
+        for path in [ctr.ctr_path, get_image_path(ctr)]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                manifest.append([path, stat.st_size, stat.st_mtime_ns])
+            else:
+                manifest.append([path, None, None])
+
+    return hashlib.sha1(json.dumps(manifest).encode("utf-8")).hexdigest()
+
+
+def build_contour_archive(archive_path=None, force=False):
+    """
+    Write all the image and label pairs with their case and image number in one compressed archive. The archive
+    is rebuilt only when the manifest hash of the source files changed.
+    :param archive_path: path of the archive, by default ARCHIVE_PATH
+    :param force: rebuild the archive even if the source didn't change
+    :return: True if the archive was written
+    """
+
+    if archive_path is None:
+        archive_path = ARCHIVE_PATH
+
+    contours = __get_all_contours(CONTOUR_PATH)
+    manifest_hash = get_manifest_hash(contours)
+
+    if not force and os.path.exists(archive_path):
+        with np.load(archive_path) as archive:
+            if str(archive["manifest_hash"]) == manifest_hash:
+                return False
+
+    imgs, labels, cases, img_nos, ctr_paths = [], [], [], [], []
+
+    for ctr in contours:
+        try:
+            img, label = load_contour(ctr, IMG_PATH)
+
+        except (IOError, AttributeError):
+            continue
+
+        imgs.append(img.astype(np.uint8))
+        labels.append(label)
+        cases.append(ctr.case)
+        img_nos.append(ctr.img_no)
+        ctr_paths.append(ctr.ctr_path)
+
+    np.savez_compressed(archive_path, images=np.array(imgs, dtype=np.uint8), labels=np.array(labels, dtype=np.uint8),
+                        cases=np.array(cases), img_nos=np.array(img_nos, dtype=np.int32),
+                        ctr_paths=np.array(ctr_paths), manifest_hash=np.array(manifest_hash))
+
+    return True
+
+
+def load_contour_archive(archive_path=None):
+    """
+    Load the archive written by build_contour_archive, the archive is built or rebuilt first if the source
+    files changed. The archive is loaded once per process.
+    :param archive_path: path of the archive, by default ARCHIVE_PATH
+    :return: dictionary with the images, the labels, the cases, the image numbers, the contour paths and
+    the index (case, image number) -> position
+    """
+
+    global loaded_archive
+
+    if archive_path is None:
+        archive_path = ARCHIVE_PATH
+
+    if loaded_archive is not None and loaded_archive["path"] == archive_path:
+        return loaded_archive
+
+    build_contour_archive(archive_path)
+
+    with np.load(archive_path) as archive:
+        res = dict((name, archive[name]) for name in ["images", "labels", "cases", "img_nos", "ctr_paths"])
+
+    res["path"] = archive_path
+    res["index"] = dict(((case, int(img_no)), idx) for idx, (case, img_no) in
+                        enumerate(zip(res["cases"].tolist(), res["img_nos"].tolist())))
+    loaded_archive = res
+
+    return res
+
+
+def get_archive_positions(batch, archive):
+    """
+    Find the contours of a batch in the archive, the contours without image are skipped.
+    :param batch: an array with all path to contour file.
+    :param archive: archive returned by load_contour_archive
+    :return: list with the positions in the archive
+    """
+
+    return [archive["index"][(ctr.case, ctr.img_no)] for ctr in batch if (ctr.case, ctr.img_no) in archive["index"]]
+
+
 def __export_all_contours(batch, img_path):
     """
-    Function return an array with all images and labels for a specific batch.
+    Function return an array with all images and labels for a specific batch. The images of IMG_PATH are
+    read from the contour archive.
     :param batch: an array with all path to contour file.
     :param img_path: image path to all images
     :return: return two arrays, one for images and one for labels
@@ -141,6 +265,19 @@ def __export_all_contours(batch, img_path):
     if len(batch) == 0:
         return
 
+    if img_path == IMG_PATH:
+        archive = load_contour_archive()
+        positions = get_archive_positions(batch, archive)
+
+        for idx, position in enumerate(positions):
+            if idx % 50 == 0:
+                plt.imshow(archive["images"][position], cmap='gray')
+                plt.show()
+                plt.imshow(archive["labels"][position])
+                plt.show()
+
+        return archive["images"][positions].astype(float), archive["labels"][positions]
+
     for idx, ctr in enumerate(batch):
         try:
             img, label = load_contour(ctr, img_path)
@@ -161,26 +298,43 @@ def __export_all_contours(batch, img_path):
 
 def export_all_contours(batch):
     """
-    Function return an array with all images and labels for a specific batch.
+    Function return an array with all images and labels for a specific batch, read from the contour archive.
     :param batch: an array with all path to contour file.
     :return: return two arrays, one for images and one for labels
     """
 
-    imgs, labels = [], []
-
     if len(batch) == 0:
         return
 
-    for idx, ctr in enumerate(batch):
-        try:
-            img, label = load_contour(ctr, IMG_PATH)
-            imgs.append(img)
-            labels.append(label)
+    archive = load_contour_archive()
+    positions = get_archive_positions(batch, archive)
 
-        except IOError:
-            continue
+    return archive["images"][positions].astype(float), archive["labels"][positions]
+
+
+def cache_contours(batch, mmap_path=None):
+    """
+    Select the images and the labels of a batch of contours from the contour archive, in contiguous uint8 arrays.
+    :param batch: an array with all path to contour file.
+    :param mmap_path: optional path prefix, the arrays are saved as .npy files and memory-mapped instead of
+    being kept in RAM
+    :return: return two uint8 arrays, one for images and one for labels
+    """
+
+    archive = load_contour_archive()
+    positions = get_archive_positions(batch, archive)
 
-    return np.array(imgs), np.array(labels)
+    imgs = archive["images"][positions]
+    labels = archive["labels"][positions]
+
+    if mmap_path is not None:
+        np.save(mmap_path + "_images.npy", imgs)
+        np.save(mmap_path + "_labels.npy", labels)
+
+        imgs = np.load(mmap_path + "_images.npy", mmap_mode="r")
+        labels = np.load(mmap_path + "_labels.npy", mmap_mode="r")
+
+    return imgs, labels
 
 
 def convert_dicom_to_png(ctrs):
@@ -197,9 +351,8 @@ def convert_dicom_to_png(ctrs):
         dicom_data = dicom.read_file(full_path)
 
         img_new_path = full_path.replace(".dcm", ".png")
-        scipy.misc.imsave(img_new_path, dicom_data.pixel_array)
+        img = bytescale(dicom_data.pixel_array)
 
-        img = cv2.imread(img_new_path, cv2.IMREAD_GRAYSCALE)
         clahe = cv2.createCLAHE(tileGridSize=(1, 1))
         cl_img = clahe.apply(img)
         cv2.imwrite(img_new_path, cl_img)
@@ -233,3 +386,10 @@ def get_all_contours():
     train_ctrs = ctrs[5:]
 
     return train_ctrs, val_ctrs
+
+
+if __name__ == "__main__":
+    if build_contour_archive(force="force" in sys.argv[1:]):
+        print("   > Arhiva " + ARCHIVE_PATH + " a fost creata")
+    else:
+        print("   > Arhiva " + ARCHIVE_PATH + " este actualizata")
@@ -1,6 +1,8 @@
 import random
 import numpy
+import pandas
 import glob
+import json
 import os
 import cv2
 import utils.settings as settings
@@ -95,13 +97,18 @@ def get_patient_transparent_overlays(patient_id):
 
 def get_patient_files(patient_id, file_type, extension=".png"):
     """
-    Get patient files.
+    Get patient files. With settings.USE_IMAGE_STORE the patient images are not written as files, they are read
+    with image_store.enumerate_patient_images.
     :param patient_id: patiend id
     :param file_type: file type
     :param extension: extension of the file
     :return: return all the file
     """
 
+    if file_type == "images" and settings.USE_IMAGE_STORE:
+        raise ValueError("The images of patient " + str(patient_id) + " are in the image store, "
+                         "use image_store.enumerate_patient_images")
+
     src_dir = get_pred_patient_dir(patient_id)
 
     if file_type == "images":
@@ -146,31 +153,306 @@ def get_files(scan_dir, search_pattern):
     return file_paths
 
 
-def enumerate_sax_files(patient_ids=None, filter_slice_type="sax"):
+def get_patient_dir_sort_key(patient_dir):
+    """
+    Sort key for patient directories, numeric patient ids are sorted as numbers.
+    :param patient_dir: patient directory
+    :return: the sort key
+    """
+
+    parent_dir, name = os.path.split(patient_dir)
+
+    if name.isdigit():
+        return parent_dir, 0, int(name), name
+
+    return parent_dir, 1, 0, name
+
+
+def get_sub_dirs(scan_dir):
+    """
+    List the sub directories of a directory with os.scandir.
+    :param scan_dir: directory path
+    :return: sorted list with the sub directory names
+    """
+
+    with os.scandir(scan_dir) as entries:
+        return sorted(entry.name for entry in entries if entry.is_dir())
+
+
+def scan_patient_series_dirs(patient_dir, filter_slice_type="sax", visited_dirs=None):
+    """
+    Find the series directories (study/series) of a patient directory.
+    :param patient_dir: the patient directory
+    :param filter_slice_type: filter slice type
+    :param visited_dirs: optional list which receives the patient directory and its study directories
+    :return: list with the series directories
+    """
+
+    series_dirs = []
+
+    if visited_dirs is not None:
+        visited_dirs.append(patient_dir)
+
+    for study_name in get_sub_dirs(patient_dir):
+        study_dir = patient_dir + "/" + study_name
+
+        if visited_dirs is not None:
+            visited_dirs.append(study_dir)
+
+        for series_name in get_sub_dirs(study_dir):
+            if filter_slice_type in series_name:
+                series_dirs.append(study_dir + "/" + series_name)
+
+    return series_dirs
+
+
+def scan_series_dirs(root_dir, patient_ids=None, filter_slice_type="sax", visited_dirs=None, patient_dirs=None):
+    """
+    Find the series directories (patient/study/series) below root_dir. A patient directory is a directory with a
+    numeric name, the patient directories which are not in patient_ids are skipped without being scanned.
+    :param root_dir: directory to scan
+    :param patient_ids: set with the patient ids as int
+    :param filter_slice_type: filter slice type
+    :param visited_dirs: optional list which receives the directories scanned above the patient directories
+    :param patient_dirs: optional dictionary which receives patient id -> the patient and study directories scanned
+    :return: return enumerate patient id and series directory
+    """
+
+    dirs = [root_dir.rstrip("/")]
+
+    while dirs:
+        scan_dir = dirs.pop()
+
+        if visited_dirs is not None:
+            visited_dirs.append(scan_dir)
+
+        for name in reversed(get_sub_dirs(scan_dir)):
+            sub_dir = scan_dir + "/" + name
+
+            if not name.isdigit():
+                dirs.append(sub_dir)
+                continue
+
+            if patient_ids is not None and int(name) not in patient_ids:
+                continue
+
+            patient_visited_dirs = None
+            if patient_dirs is not None:
+                patient_visited_dirs = patient_dirs.setdefault(int(name), [])
+
+            for series_dir in scan_patient_series_dirs(sub_dir, filter_slice_type, patient_visited_dirs):
+                yield int(name), series_dir
+
+
+def get_dir_mtimes(dirs):
+    """
+    Get the modification times of directories.
+    :param dirs: the directories
+    :return: dictionary directory -> mtime in nanoseconds
+    """
+
+    return dict((scan_dir, os.stat(scan_dir).st_mtime_ns) for scan_dir in dirs)
+
+
+def is_dir_mtimes_valid(dir_mtimes):
+    """
+    Check that the directories still exist and were not modified.
+    :param dir_mtimes: dictionary directory -> mtime in nanoseconds
+    :return: True if no directory changed
+    """
+
+    for scan_dir, mtime in dir_mtimes.items():
+        if not os.path.exists(scan_dir) or os.stat(scan_dir).st_mtime_ns != mtime:
+            return False
+
+    return True
+
+
+def load_sax_manifest(filter_slice_type="sax", refresh=False):
+    """
+    Load the cached manifest patient id -> series directories. The manifest is rebuilt when it doesn't exist,
+    when refresh is set or when one of the directories above the patient directories was modified. A patient
+    whose patient or study directories were modified, e.g. by a new or a removed series, is scanned again.
+    :param filter_slice_type: filter slice type
+    :param refresh: rebuild the manifest
+    :return: dictionary patient id -> list with the series directories
+    """
+
+    manifest_path = settings.BASE_DIR + settings.RESULT_DIR + "sax_manifest.json"
+
+    if os.path.exists(manifest_path) and not refresh:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        if manifest["filter_slice_type"] == filter_slice_type and "patient_dir_mtimes" in manifest and \
+                is_dir_mtimes_valid(manifest["dir_mtimes"]):
+            changed = False
+
+            for patient_id, dir_mtimes in manifest["patient_dir_mtimes"].items():
+                if is_dir_mtimes_valid(dir_mtimes):
+                    continue
+
+                patient_dir = min(dir_mtimes, key=len)
+                visited_dirs = []
+                manifest["patients"][patient_id] = scan_patient_series_dirs(patient_dir, filter_slice_type,
+                                                                            visited_dirs)
+                manifest["patient_dir_mtimes"][patient_id] = get_dir_mtimes(visited_dirs)
+                changed = True
+
+            if changed:
+                with open(manifest_path, "w") as f:
+                    json.dump(manifest, f)
+
+            return dict((int(patient_id), series_dirs) for patient_id, series_dirs in manifest["patients"].items()
+                        if len(series_dirs) > 0)
+
+    visited_dirs = []
+    patient_dirs = {}
+    patients = {}
+
+    for patient_id, series_dir in scan_series_dirs(settings.BASE_DIR + "data", filter_slice_type=filter_slice_type,
+                                                   visited_dirs=visited_dirs, patient_dirs=patient_dirs):
+        patients.setdefault(patient_id, []).append(series_dir)
+
+    create_dir_if_not_exists(settings.BASE_DIR + settings.RESULT_DIR)
+    with open(manifest_path, "w") as f:
+        json.dump({"filter_slice_type": filter_slice_type,
+                   "dir_mtimes": get_dir_mtimes(visited_dirs),
+                   "patient_dir_mtimes": dict((str(patient_id), get_dir_mtimes(dirs)) for patient_id, dirs in
+                                              patient_dirs.items()),
+                   "patients": dict((str(patient_id), patients.get(patient_id, [])) for patient_id in
+                                    patient_dirs)},
+                  f)
+
+    return patients
+
+
+def enumerate_series_dirs(patient_ids=None, filter_slice_type="sax", root_dir=None, use_manifest=False):
+    """
+    Enumerate the series directories.
+    :param patient_ids: the patient ids, int or numeric strings
+    :param filter_slice_type: filter slice type
+    :param root_dir: directory to scan, by default the data directory
+    :param use_manifest: use the cached manifest of the data directory instead of scanning it
+    :return: sorted list with the series directories
+    """
+
+    if patient_ids is not None:
+        patient_ids = set(int(patient_id) for patient_id in patient_ids)
+
+    if use_manifest and root_dir is None:
+        manifest = load_sax_manifest(filter_slice_type=filter_slice_type)
+        series_dirs = [series_dir for patient_id, patient_series_dirs in manifest.items()
+                       if patient_ids is None or patient_id in patient_ids for series_dir in patient_series_dirs]
+    else:
+        if root_dir is None:
+            root_dir = settings.BASE_DIR + "data"
+
+        series_dirs = [series_dir for _, series_dir in scan_series_dirs(root_dir, patient_ids=patient_ids,
+                                                                         filter_slice_type=filter_slice_type)]
+
+    return sorted(series_dirs)
+
+
+def enumerate_patient_dirs(filter_slice_type="sax", use_manifest=False):
+    """
+    Enumerate the patient directories which contain sax files.
+    :param filter_slice_type: filter slice type
+    :param use_manifest: use the cached manifest of the data directory
+    :return: sorted list with the patient directories
+    """
+
+    patient_dirs = set()
+
+    for series_dir in enumerate_series_dirs(filter_slice_type=filter_slice_type, use_manifest=use_manifest):
+        parts = series_dir.split('/')
+        patient_dirs.add("/".join(parts[:len(parts) - 2]))
+
+    return sorted(patient_dirs, key=get_patient_dir_sort_key)
+
+
+def enumerate_sax_paths(patient_ids=None, filter_slice_type="sax", root_dir=None, use_manifest=False):
+    """
+    Enumerate the paths of the sax files.
+    :param patient_ids: the patient ids, int or numeric strings
+    :param filter_slice_type: filter slice type
+    :param root_dir: directory to scan, by default the data directory
+    :param use_manifest: use the cached manifest of the data directory instead of scanning it
+    :return: return enumerate directory and file name
+    """
+
+    for series_dir in enumerate_series_dirs(patient_ids=patient_ids, filter_slice_type=filter_slice_type,
+                                            root_dir=root_dir, use_manifest=use_manifest):
+        with os.scandir(series_dir) as entries:
+            file_names = sorted(entry.name for entry in entries if entry.name.endswith(".dcm") and entry.is_file())
+
+        for file_name in file_names:
+            yield series_dir + "/", file_name
+
+
+def enumerate_sax_files(patient_ids=None, filter_slice_type="sax", metadata_only=False, root_dir=None,
+                        use_manifest=False):
     """
     Enumerate sax files.
-    :param patient_ids: the patient ids
+    :param patient_ids: the patient ids, int or numeric strings
     :param filter_slice_type: filter slice type
+    :param metadata_only: read only the DICOM header, the pixel data is loaded on demand
+    :param root_dir: directory to scan, by default the data directory
+    :param use_manifest: use the cached manifest of the data directory instead of scanning it
     :return: return enumerate dicom data
     """
 
-    for root, _, files in os.walk(settings.BASE_DIR + "data"):
-        for file_name in files:
-            if file_name.endswith(".dcm"):
+    for file_dir, file_name in enumerate_sax_paths(patient_ids=patient_ids, filter_slice_type=filter_slice_type,
+                                                   root_dir=root_dir, use_manifest=use_manifest):
+        dicom_data = DicomWrapper(file_dir, file_name, metadata_only=metadata_only)
 
-                parts = root.split('/')
-                patient_id = parts[len(parts) - 3]
-                slice_type = parts[len(parts) - 1]
-                if filter_slice_type not in slice_type:
-                    continue
+        yield dicom_data
 
-                if patient_ids is not None:
-                    if patient_id not in patient_ids:
-                        continue
 
-                dicom_data = DicomWrapper(root + "/", file_name)
+def get_metadata_path(name):
+    """
+    Return the path of a metadata table in the format selected by settings.METADATA_FORMAT.
+    :param name: table name, e.g. dicom_data_enriched
+    :return: the path
+    """
 
-                yield dicom_data
+    return settings.BASE_DIR + settings.RESULT_DIR + name + "." + settings.METADATA_FORMAT
+
+
+def save_metadata(data_frame, name):
+    """
+    Save a metadata table. With METADATA_FORMAT "npy" the table is saved as a NumPy structured array with
+    typed columns, the text columns are stored as fixed width strings.
+    :param data_frame: the table
+    :param name: table name
+    :return: nothing
+    """
+
+    if settings.METADATA_FORMAT == "npy":
+        column_dtypes = {}
+        for column in data_frame.columns:
+            if not pandas.api.types.is_numeric_dtype(data_frame[column]):
+                width = data_frame[column].astype(str).str.len().max() if len(data_frame) else 1
+                column_dtypes[column] = "U" + str(max(width, 1))
+
+        records = data_frame.to_records(index=False, column_dtypes=column_dtypes)
+        numpy.save(get_metadata_path(name), records, allow_pickle=False)
+    else:
+        data_frame.to_csv(get_metadata_path(name), sep=";")
+
+
+def load_metadata(name, index_col=None):
+    """
+    Load a metadata table saved by save_metadata.
+    :param name: table name
+    :param index_col: index column of the CSV file
+    :return: the table
+    """
+
+    if settings.METADATA_FORMAT == "npy":
+        return pandas.DataFrame.from_records(numpy.load(get_metadata_path(name), allow_pickle=False))
+
+    return pandas.read_csv(get_metadata_path(name), sep=";", index_col=index_col)
 
 
 def compute_mean_image(src_dir, wildcard, img_size):
@@ -229,6 +511,37 @@ def compute_mean_pixel_values_dir(src_dir, wildcard, channels):
     return res
 
 
+def normalize_image(image):
+    """
+    Zero-center and normalize one image, the result doesn't depend on the other images of the batch.
+    :param image: the image
+    :return: normalized float32 image
+    """
+
+    res = numpy.float32(image)
+    res -= numpy.mean(res, dtype=numpy.float32)
+    std = numpy.std(res, dtype=numpy.float32)
+
+    if std > 0:
+        res /= std
+
+    return res
+
+
+def normalize_batch(images):
+    """
+    Zero-center and normalize a batch with the mean and the standard deviation of the whole batch.
+    :param images: the images
+    :return: normalized float32 images
+    """
+
+    res = numpy.float32(images)
+    res -= numpy.mean(res, dtype=numpy.float32)
+    res /= numpy.std(res, dtype=numpy.float32)
+
+    return res
+
+
 def replace_color(src_image, from_color, to_color):
     """
     Replace color
@@ -1,17 +1,56 @@
 import dicom
 import numpy
 
+METADATA_TAGS = ["Columns", "Rows", "PixelSpacing", "SliceLocation", "InstanceCreationTime", "SliceThickness",
+                 "SequenceName", "ImagePositionPatient", "SeriesNumber", "SeriesTime", "PatientID",
+                 "SeriesDescription", "ImageOrientationPatient", "FlipAngle", "InstanceNumber",
+                 "InPlanePhaseEncodingDirection", "SequenceVariant", "Manufacturer", "ManufacturerModelName",
+                 "PatientAge", "PatientBirthDate", "PatientSex"]
+
+
+def bytescale(pixels):
+    """
+    Scale the pixel values to uint8 the same way scipy.misc.imsave does before writing a png.
+    :param pixels: the pixel array
+    :return: uint8 image
+    """
+
+    data = pixels.astype(numpy.float64)
+    low = data.min()
+    high = data.max()
+    scale = 255. / ((high - low) or 1.)
+
+    res = ((data - low) * scale).clip(0, 255) + 0.5
+
+    return res.astype(numpy.uint8)
+
 
 class DicomWrapper:
-    def __init__(self, file_dir, file_name):
-        self.raw_file = dicom.read_file(file_dir + file_name)
+    def __init__(self, file_dir, file_name, metadata_only=False):
+        """
+        Read a DICOM file.
+        :param file_dir: directory of the file
+        :param file_name: name of the file
+        :param metadata_only: stop reading before the pixel data, the pixels are loaded when pixel_array is used
+        """
+
+        self.file_path = file_dir + file_name
         self.file_name = file_name
-        loc1 = self.get_location()
-        loc2 = self.slice_location
+        self.metadata_only = metadata_only
+        self.values = {}
+        self.raw_file = dicom.read_file(self.file_path, stop_before_pixels=metadata_only)
+
+        if metadata_only:
+            for name in METADATA_TAGS:
+                element = self.raw_file.data_element(name)
+                if element is not None:
+                    self.values[name] = element.value
 
     def get_value(self, name):
-        res = self.raw_file.data_element(name).value
-        return res
+        if name not in self.values:
+            self.values[name] = self.raw_file.data_element(name).value
+
+        return self.values[name]
 
     @property
     def columns(self):
@@ -95,9 +134,19 @@ class DicomWrapper:
 
     @property
     def pixel_array(self):
-        img = self.raw_file.pixel_array.astype(float) / numpy.max(self.raw_file.pixel_array)
+        if self.metadata_only:
+            self.raw_file = dicom.read_file(self.file_path)
+            self.metadata_only = False
+
+        pixels = self.raw_file.pixel_array
+        img = pixels.astype(float) / numpy.max(pixels)
         return img
 
+    @property
+    def pixel_array_uint8(self):
+        img = self.pixel_array
+        return bytescale(img)
+
     def get_csv(self):
         res = [self.series_number, self.get_value("InstanceNumber"), self.flip_angle, self.series_description,
                self.series_time]